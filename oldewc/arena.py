@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+arena.py: A module from EWC (http://piclab.com/ewc/).
+
+A flat representation of the dom for very large documents.  Rather
+than one Python object per node, a NodeStore keeps every node of a
+document in a set of parallel integer arrays (type, parent, first
+child, last child, next sibling, and the offset and length of its
+text in one shared buffer, which holds it encoded as UTF-8).  Attribute maps and table
+spans are kept in dicts only for the nodes that have them.
+
+Nodes are read and changed through proxies made on demand, which
+are instances of classes derived from the dom classes, so they pass
+the same isinstance() tests, have the same methods, and can be
+visited by any DomVisitor.  Two proxies of the same node compare
+equal.  Use MarkupParser.parse(source, flat=True) to parse into one.
+
+>>> import arena, parser, dom, StringIO
+>>> source = "== Title ==\\n\\nSome **bold** text.\\n* one\\n* two\\n"
+>>> doc = parser.MarkupParser().parse(StringIO.StringIO(source), flat=True)
+>>> isinstance(doc, dom.Document), len(doc.store)
+(True, 14)
+>>> html = "".join(doc.visit(dom.HTMLDomVisitor()))
+>>> html == parser.convertString(source)
+True
+>>> doc[0][1][1][0].value
+u'bold'
+"""
+
+from array import array
+
+# relative imports
+import dom
+
+NONE = -1
+
+# Concrete node classes, indexed by type code
+nodeClasses = (dom.Document, dom.Division, dom.Paragraph, dom.Heading,
+    dom.Rule, dom.UnorderedList, dom.OrderedList, dom.DictionaryList,
+    dom.ListItem, dom.DictionaryTerm, dom.DictionaryDef, dom.Table,
+    dom.TableRow, dom.TableData, dom.TableHeading, dom.Span, dom.Break,
+    dom.Link, dom.Image, dom.Text, dom.Comment)
+
+typeCodes = dict((c, i) for i, c in enumerate(nodeClasses))
+
+class FlatNode(object):
+    """
+    Behavior shared by all proxies: each is just a reference to a
+    store and the index of a node in it, and overrides the storage
+    of the dom classes with lookups in the store.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return isinstance(other, FlatNode) and self.store is other.store \
+            and self.index == other.index
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash((id(self.store), self.index))
+
+    def _getparent(self):
+        return self.store.node(self.store.parents[self.index])
+    def _setparent(self, parent):
+        if parent is None:
+            self.store.parents[self.index] = NONE
+        else:
+            self.store.parents[self.index] = parent.index
+    parent = property(_getparent, _setparent)
+
+    def _child_indices(self):
+        s = self.store
+        v = []
+        i = s.first[self.index]
+        while NONE != i:
+            v.append(i)
+            i = s.next[i]
+        return v
+
+    def _getchildren(self):
+        """
+        A new list of proxies; changing the list does not change the
+        node, but assigning a list to children does.
+        """
+        node = self.store.node
+        return [node(i) for i in self._child_indices()]
+    def _setchildren(self, children):
+        self.store.link(self.index, [self._adopt(c) for c in children])
+    children = property(_getchildren, _setchildren)
+
+    def _adopt(self, child):
+        """
+        Index in our store of a child about to be added to this node:
+        the node itself if it is one of ours, or a copy of it (and its
+        subtree) if it comes from an ordinary dom tree.
+        """
+        if isinstance(child, FlatNode) and child.store is self.store:
+            return child.index
+        return self.store.copy_tree(child)
+
+    def _ok_to_add(self, node):
+        if not isinstance(node, self.allowed_contents):
+            raise dom.NestingError(self, node)
+        return node
+
+    def __len__(self):
+        s = self.store
+        n = 0
+        i = s.first[self.index]
+        while NONE != i:
+            n += 1
+            i = s.next[i]
+        return n
+    def __nonzero__(self):
+        return NONE != self.store.first[self.index]
+    def __iter__(self):
+        s = self.store
+        i = s.first[self.index]
+        while NONE != i:
+            yield s.node(i)
+            i = s.next[i]
+    def __getitem__(self, key):
+        return self.children[key]
+    def __delitem__(self, key):
+        v = self._child_indices()
+        del v[key]
+        self.store.link(self.index, v)
+    def __setitem__(self, key, child):
+        v = self._child_indices()
+        v[key] = self._adopt(self._ok_to_add(child))
+        self.store.link(self.index, v)
+    def append(self, child):
+        self.store.append(self.index, self._adopt(self._ok_to_add(child)))
+    def extend(self, v):
+        for c in v: self.append(c)
+    def insert(self, i, child):
+        v = self._child_indices()
+        v.insert(i, self._adopt(self._ok_to_add(child)))
+        self.store.link(self.index, v)
+    def pop(self, i=-1):
+        v = self._child_indices()
+        j = v.pop(i)
+        self.store.link(self.index, v)
+        return self.store.node(j)
+    def remove(self, node):
+        v = self._child_indices()
+        v.remove(node.index)
+        self.store.link(self.index, v)
+
+    def _getvalue(self):
+        return self.store.get_text(self.index)
+    def _setvalue(self, text):
+        self.store.set_text(self.index, dom.makeUnicode(text))
+    _value = property(_getvalue, _setvalue)
+
+    def _getattrmap(self):
+        return self.store.attrs.get(self.index)
+    def _setattrmap(self, attr):
+        if attr is None:
+            self.store.attrs.pop(self.index, None)
+        else:
+            self.store.attrs[self.index] = attr
+    _attr = property(_getattrmap, _setattrmap)
+
+    def _getrowspan(self):
+        return self.store.spans.get(self.index, (0, 0))[0]
+    def _setrowspan(self, n):
+        self.store.set_span(self.index, n, self.colspan)
+    rowspan = property(_getrowspan, _setrowspan)
+
+    def _getcolspan(self):
+        return self.store.spans.get(self.index, (0, 0))[1]
+    def _setcolspan(self, n):
+        self.store.set_span(self.index, self.rowspan, n)
+    colspan = property(_getcolspan, _setcolspan)
+
+def proxyClass(c):
+    return type("Flat" + c.__name__, (FlatNode, c),
+        { "__slots__": ("store", "index") })
+
+proxyClasses = tuple(proxyClass(c) for c in nodeClasses)
+
+class NodeStore(object):
+    """
+    The arrays holding the nodes of one document.
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.types = array("b")
+        self.parents = array("i")
+        self.first = array("i")
+        self.last = array("i")
+        self.next = array("i")
+        self.start = array("i")
+        self.length = array("i")
+        self.text = array("c")
+        self.attrs = {}
+        self.spans = {}
+
+    def __len__(self):
+        return len(self.types)
+
+    def node(self, i):
+        """
+        Proxy for the node at index i (None for NONE).
+        """
+        if NONE == i:
+            return None
+        p = proxyClasses[self.types[i]].__new__(proxyClasses[self.types[i]])
+        p.store = self
+        p.index = i
+        return p
+
+    def new(self, c, parent=None):
+        """
+        Index of a new node of dom class c, appended to the children of
+        the node at index parent if given.
+        """
+        i = len(self.types)
+        self.types.append(typeCodes[c])
+        self.parents.append(NONE)
+        self.first.append(NONE)
+        self.last.append(NONE)
+        self.next.append(NONE)
+        self.start.append(0)
+        self.length.append(0)
+        if parent is not None:
+            self.append(parent, i)
+        return i
+
+    def create(self, c, parent=None):
+        """
+        Proxy for a new node of dom class c, appended to parent (a
+        proxy) if given.
+        """
+        if parent is None:
+            return self.node(self.new(c))
+        return self.node(self.new(c, parent.index))
+
+    def append(self, parent, i):
+        self.unlink(i)
+        self.parents[i] = parent
+        if NONE == self.last[parent]:
+            self.first[parent] = i
+        else:
+            self.next[self.last[parent]] = i
+        self.last[parent] = i
+
+    def unlink(self, i):
+        """
+        Take the node at index i out of its parent's children.
+        """
+        parent = self.parents[i]
+        if NONE == parent:
+            return
+        v = []
+        j = self.first[parent]
+        while NONE != j:
+            if j != i:
+                v.append(j)
+            j = self.next[j]
+        self.link(parent, v)
+        self.parents[i] = NONE
+
+    def link(self, parent, v):
+        """
+        Make the nodes at the indices in v the children of parent, in
+        order, replacing its old children.
+        """
+        j = self.first[parent]
+        while NONE != j:
+            k = self.next[j]
+            self.next[j] = NONE
+            if self.parents[j] == parent:
+                self.parents[j] = NONE
+            j = k
+
+        for i in v:
+            if NONE != self.parents[i] and self.parents[i] != parent:
+                self.unlink(i)
+            self.parents[i] = parent
+        for a, b in zip(v, v[1:]):
+            self.next[a] = b
+        if v:
+            self.first[parent] = v[0]
+            self.last[parent] = v[-1]
+            self.next[v[-1]] = NONE
+        else:
+            self.first[parent] = NONE
+            self.last[parent] = NONE
+
+    def get_text(self, i):
+        s = self.start[i]
+        return self.text[s:s+self.length[i]].tostring().decode("utf-8")
+
+    def set_text(self, i, value):
+        """
+        Text of a node is never changed in place; the new value goes at
+        the end of the buffer, unless the old one is already there, in
+        which case it is replaced.  So a node built up line by line
+        doesn't leave a copy of each step behind.  compact() reclaims
+        the rest.
+        """
+        s = self.start[i]
+        if s + self.length[i] == len(self.text) and self.length[i]:
+            del self.text[s:]
+        else:
+            self.start[i] = len(self.text)
+        value = value.encode("utf-8")
+        self.text.fromstring(value)
+        self.length[i] = len(value)
+
+    def set_span(self, i, rowspan, colspan):
+        if rowspan or colspan:
+            self.spans[i] = (rowspan, colspan)
+        else:
+            self.spans.pop(i, None)
+
+    def copy_tree(self, node):
+        """
+        Copy an ordinary dom node and its subtree into the store,
+        returning the index of the copy (which has no parent yet).
+        """
+        top = None
+        pending = [(node, NONE)]
+        while pending:
+            n, parent = pending.pop()
+            if parent == NONE:
+                i = self.new(n.__class__)
+                top = i
+            else:
+                i = self.new(n.__class__, parent)
+
+            if isinstance(n, dom.CharacterData):
+                if n.value:
+                    self.set_text(i, n.value)
+                continue
+            if n._attr:
+                self.attrs[i] = n._attr
+            if isinstance(n, dom.BaseTableData):
+                self.set_span(i, n.rowspan, n.colspan)
+            pending.extend((c, i) for c in reversed(n.children))
+        return top
+
+    def compact(self):
+        """
+        Rewrite the text buffer holding only the current text of each
+        node, dropping values that have since been replaced.
+        """
+        text = array("c")
+        for i in xrange(len(self.types)):
+            if self.length[i]:
+                s = self.start[i]
+                self.start[i] = len(text)
+                text.extend(self.text[s:s+self.length[i]])
+        self.text = text
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+batch.py: A module from EWC (http://piclab.com/ewc/).
+
+Converting large numbers of documents at once, spread over a pool
+of worker processes.
+"""
+
+import traceback, multiprocessing
+
+# relative imports
+import config, parser
+
+class BatchResult(object):
+    """
+    Outcome of converting one item of a batch, identified by its
+    position in the input.  Exactly one of html and error is None;
+    error holds the formatted traceback of whatever went wrong.
+    """
+    def __init__(self, index, html, error):
+        object.__init__(self)
+        self.index = index
+        self.html = html
+        self.error = error
+
+    def ok(self):
+        return self.error is None
+
+def currentSettings(context=None):
+    """
+    Snapshot of the settings of context (or of the global context)
+    that affect output, to be installed in each worker process.
+
+    >>> import batch, config
+    >>> c = config.parsingContext.copy()
+    >>> c.localLinkPattern = "/wiki/%s"
+    >>> batch.currentSettings(c)["localLinkPattern"]
+    '/wiki/%s'
+    """
+    pc = context or config.parsingContext
+    settings = dict((name, getattr(pc, name))
+        for name in config.contextSettings)
+    settings["quotesAndDashes"] = pc.quotesAndDashes
+    settings["emAndStrong"] = pc.emAndStrong
+    settings["nakedURLs"] = pc.nakedURLs
+    return settings
+
+def installSettings(settings):
+    pc = config.parsingContext
+    for name, value in settings.iteritems():
+        if hasattr(pc, name):
+            setattr(pc, name, value)
+        else:
+            setattr(config, name, value)
+
+# Context for the items converted by a worker process
+worker = {}
+
+def installWorker(settings, context):
+    installSettings(settings)
+    worker["context"] = context
+
+def convertItem(task):
+    """
+    Worker function: convert one (index, item, isPath, hd) task.
+    Only the source text (or path) goes to the worker and only the
+    resulting HTML or error message comes back.
+    """
+    return convertTask(task, worker.get("context"))
+
+def convertTask(task, context):
+    index, item, isPath, hd = task
+    if context is not None:
+        context = context.copy()
+    try:
+        if isPath:
+            f = open(item)
+            try:
+                ins = f.read()
+            finally:
+                f.close()
+        else:
+            ins = item
+        return index, parser.convertString(ins, hd, context), None
+    except Exception:
+        return index, None, traceback.format_exc()
+
+def convertMany(items, hd=0, paths=False, processes=None, chunksize=8,
+    ordered=True, context=None):
+    """
+    Convert each of items (source strings, or file names if paths is
+    true) to HTML with the settings of context (or of the global
+    context) using a pool of processes (one per CPU by default),
+    yielding a BatchResult for each.  Tasks are handed to the workers
+    chunksize at a time.  Results come back in input order unless
+    ordered is false, in which case they are yielded as they finish.
+    A failure in one item is reported in its result and does not stop
+    the batch.
+
+    >>> import batch
+    >>> items = ["**bold**", "[[Link]]", "{{}}"]
+    >>> for r in batch.convertMany(items, processes=2):
+    ...     print r.index, r.ok()
+    0 True
+    1 True
+    2 False
+    >>> c = config.parsingContext.copy()
+    >>> c.localLinkPattern = "/wiki/%s"
+    >>> [r.html.split("\\n")[-1] for r in
+    ...     batch.convertMany(["[[Page]]"], processes=2, context=c)]
+    [u'<a href="/wiki/page">Page</a></p></div>']
+    """
+    tasks = ((i, item, paths, hd) for i, item in enumerate(items))
+    context = (context or config.parsingContext).copy()
+    settings = currentSettings(context)
+
+    if 1 == processes:
+        for index, html, error in (convertTask(t, context) for t in tasks):
+            yield BatchResult(index, html, error)
+        return
+
+    pool = multiprocessing.Pool(processes, installWorker, (settings, context))
+    try:
+        if ordered:
+            results = pool.imap(convertItem, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(convertItem, tasks, chunksize)
+        for index, html, error in results:
+            yield BatchResult(index, html, error)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+"""
+bench.py: A module from EWC (http://piclab.com/ewc/).
+
+Performance measurements of the parser on synthetic documents.
+Run this module directly to print the results; see main() for
+options to save them as a baseline and check later runs against it.
+
+Timings depend on the machine, so no baseline is kept in the source
+tree.  Make one on the machine the checks will run on before changing
+anything, and compare against it afterwards:
+
+    python bench.py --save baseline.json
+    python bench.py --baseline baseline.json
+"""
+
+import sys, os, time, random, resource, tempfile, StringIO
+import json, multiprocessing
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# relative imports
+import config, dom, parser, extensions, instrument, scan
+
+def inlineParagraph(markers):
+    """
+    Text of one paragraph containing the given number of inline
+    markup items of various kinds.
+    """
+    kinds = (u"**b%d**", u"//i%d//", u"[[Page %d]]", u"<<.c x%d>>",
+        u"{{i%d.png}}", u"a\\\\b%d", u"\"q%d\"", u"##t%d##")
+    words = []
+    for i in xrange(markers):
+        words.append(kinds[i % len(kinds)] % i)
+        words.append(u"word")
+    return u" ".join(words)
+
+def timeInline(markers, repeat=3):
+    """
+    Best time of several runs of the inline pass over a single
+    paragraph with the given number of markers.
+    """
+    text = inlineParagraph(markers)
+    best = None
+    for i in xrange(repeat):
+        p = parser.MarkupParser()
+        para = dom.Paragraph(p.stack[0])
+        para.addText(text)
+
+        start = time.time()
+        p.doInlineMarkup(para)
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def benchInline(sizes=(1250, 2500, 5000, 10000)):
+    """
+    Time per marker should stay flat as paragraphs get longer.
+    """
+    print "Inline markup, one paragraph:"
+    print "  markers   seconds   usec/marker"
+    for n in sizes:
+        t = timeInline(n)
+        print "  %7d %9.3f %13.2f" % (n, t, 1e6 * t / n)
+
+#
+# Corpora.  Each function takes a scale and returns source text that
+# grows linearly with it, roughly a hundred lines per unit.  The same
+# scale always gives the same text.
+#
+words = ("alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta",
+    "theta", "iota", "kappa", "lambda", "mu", "nu", "xi", "omicron")
+
+def proseCorpus(scale):
+    """
+    Plain paragraphs with almost no markup.
+    """
+    r = random.Random(scale)
+    lines = []
+    for i in xrange(20 * scale):
+        for j in xrange(r.randint(2, 7)):
+            lines.append(" ".join(r.choice(words) for k in xrange(12)) + ".")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def inlineCorpus(scale):
+    """
+    Paragraphs dense with inline markup of every kind.
+    """
+    r = random.Random(scale)
+    kinds = ("**%s**", "//%s//", "##%s##", ",,%s,,", "^^%s^^", "__%s__",
+        "[[Page %s]]", "[[wp:%s|text]]", "<<.c %s>>", "<<#a %s>>",
+        "{{%s.png|alt|10|20}}", "x\\\\%s", "http://example.com/%s",
+        "\"%s\"", "%s--x", "~**%s", "[[Link <<.i %s>>]]", "<<.a <<.b %s>>>>")
+    lines = []
+    for i in xrange(25 * scale):
+        for j in xrange(3):
+            v = []
+            for k in xrange(8):
+                v.append(r.choice(kinds) % r.choice(words))
+                v.append(r.choice(words))
+            lines.append(" ".join(v))
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def tableCorpus(scale):
+    """
+    Large tables with row and column spans.
+    """
+    r = random.Random(scale)
+    lines = []
+    for i in xrange(scale):
+        lines.append("|=" + "|=".join("h%d" % c for c in xrange(8)))
+        for row in xrange(98):
+            cells = []
+            for c in xrange(8):
+                k = r.random()
+                if k < 0.15 and row:
+                    cells.append("^")
+                elif k < 0.25 and c:
+                    cells.append("<")
+                else:
+                    cells.append(" %s **%d** " % (r.choice(words), c))
+            lines.append("|" + "|".join(cells))
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def listCorpus(scale):
+    """
+    Lists nested many levels deep, inside nested divisions.
+    """
+    r = random.Random(scale)
+    lines = []
+    for i in xrange(5 * scale):
+        lines.append("<<.outer%d" % i)
+        lines.append("<<.inner")
+        depth = 1
+        for j in xrange(16):
+            depth = max(1, min(12, depth + r.choice((-1, 0, 1, 1))))
+            lines.append("*" * depth + " item //%s// %d" % (r.choice(words), j))
+        lines.append("")
+        for j in xrange(depth):
+            lines.append("#" * (depth - j) + " back %d" % j)
+        lines.append(">>")
+        lines.append(">>")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def extensionCorpus(scale):
+    """
+    Inline and block extensions of every built-in kind, and
+    include directives for the files in includeDirectory().
+    """
+    r = random.Random(scale)
+    lines = []
+    for i in xrange(10 * scale):
+        w = r.choice(words)
+        lines.append("Text <<rot13 %s>> and <<!hidden %s>> and {{{raw **%s**}}}." % (w, w, w))
+        lines.append("<<include part%d.ewc name=%s>>" % (i % 4, w))
+        lines.append("<<unknown arg a=%s>>" % w)
+        lines.append("<<rot13")
+        lines.append("%s over several" % w)
+        lines.append("lines of text")
+        lines.append(">>")
+        lines.append("{{{")
+        lines.append("raw **%s** block" % w)
+        lines.append("}}}")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def manualCorpus(scale):
+    """
+    The EWC manual (docs/ewc.doc), repeated.
+    """
+    f = open(os.path.join(os.path.dirname(__file__) or ".", "docs", "ewc.doc"))
+    try:
+        text = f.read()
+    finally:
+        f.close()
+    return "\n\n".join([text] * scale)
+
+# Files included by extensionCorpus()
+includeParts = [
+    "Part %d for $$name$$, with **bold** and [[Link %d]].\n"
+    "<<rot13 included %d>> and a second line.\n" % (i, i, i)
+    for i in xrange(4)]
+
+includes = {}
+
+def includeDirectory():
+    """
+    Temporary directory holding the files of includeParts as
+    part0.ewc, part1.ewc and so on, written once per process.
+    """
+    if not "directory" in includes:
+        d = tempfile.mkdtemp(prefix="ewc-bench-")
+        for i, text in enumerate(includeParts):
+            f = open(os.path.join(d, "part%d.ewc" % i), "w")
+            try:
+                f.write(text)
+            finally:
+                f.close()
+        includes["directory"] = d
+    return includes["directory"]
+
+def corpusContext(name):
+    """
+    Context to convert corpus name with: a copy of the global one,
+    with includes from includeDirectory() for the extension corpus.
+
+    >>> import bench, parser, os
+    >>> c = bench.corpusContext("extensions")
+    >>> source = "\\n".join(bench.extensionCorpus(1).split("\\n")[:22])
+    >>> html = parser.convertString(source, context=c)
+    >>> [os.path.basename(name) for name in c.includes], u"Part 1 for" in html
+    ([u'part0.ewc', u'part1.ewc'], True)
+    """
+    c = config.parsingContext.copy()
+    if "extensions" == name:
+        c.includePath = includeDirectory()
+        c.addExtension(u"include", extensions.IncludeFile())
+    return c
+
+corpora = (
+    ("prose", proseCorpus),
+    ("inline", inlineCorpus),
+    ("tables", tableCorpus),
+    ("lists", listCorpus),
+    ("extensions", extensionCorpus),
+    ("manual", manualCorpus),
+)
+
+#
+# Measurement.
+#
+def timePhases(source, hd=0, context=None):
+    """
+    Convert source with a DictSink attached to a copy of context (or
+    of the global context), returning the HTML and a map of phase
+    names (see instrument.py) to seconds.
+
+    >>> import bench, parser, instrument
+    >>> source = "== Title ==\\n\\nSome **bold** and [[Link|linked]] text.\\n"
+    >>> html, times = bench.timePhases(source)
+    >>> html == parser.convertString(source)
+    True
+    >>> sorted(times) == sorted(instrument.phases)
+    True
+    """
+    pc = (context or config.parsingContext).copy()
+    pc.sink = instrument.DictSink()
+    html = parser.convertString(source, hd, pc)
+    return html, pc.sink.snapshot()["phases"]
+
+def measure(name, scale, repeat=3):
+    """
+    Best per-phase times of several conversions of one corpus, with
+    throughput and the growth in peak memory (in kilobytes) over the
+    process as it was before.  Run this in a fresh process (see
+    measureIsolated) for the memory figure to mean anything.
+    """
+    source = dict(corpora)[name](scale)
+    context = corpusContext(name)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    best = None
+    out = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        for i in xrange(repeat):
+            html, times = timePhases(source, context=context)
+            if best is None:
+                best = times
+            else:
+                for k, v in times.iteritems():
+                    best[k] = min(best[k], v)
+    finally:
+        sys.stdout = out
+
+    total = sum(best.itervalues())
+    lines = source.count("\n") + 1
+    tree = measureDom(source, context)
+    return {
+        "corpus": name,
+        "scale": scale,
+        "lines": lines,
+        "bytes": len(source),
+        "phases": best,
+        "seconds": total,
+        "linesPerSecond": lines / total,
+        "bytesPerSecond": len(source) / total,
+        "peakMemory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before,
+        "domBytes": tree["bytes"],
+    }
+
+def timeScan(name, scale, repeat=3):
+    """
+    Best times of several full conversions and of several scans (see
+    scan.py) of one corpus.
+    """
+    source = dict(corpora)[name](scale)
+    context = corpusContext(name)
+    convert = lambda: parser.convertString(source, context=context.copy())
+    scanOnly = lambda: scan.scanString(source, context.copy())
+    best = [None, None]
+    out = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        for i in xrange(repeat):
+            for j, f in enumerate((convert, scanOnly)):
+                start = time.time()
+                f()
+                t = time.time() - start
+                if best[j] is None or t < best[j]:
+                    best[j] = t
+    finally:
+        sys.stdout = out
+    return best
+
+def benchScan(scale=8, names=None):
+    """
+    Scanning should be several times quicker than converting.
+    """
+    print "Conversion and scan, scale %d:" % scale
+    print "  corpus       convert      scan   speedup"
+    for name, f in corpora:
+        if names and name not in names:
+            continue
+        convert, sc = timeScan(name, scale)
+        print "  %-10s %9.4f %9.4f %8.1fx" % (name, convert, sc, convert / sc)
+
+def domFootprint(doc):
+    """
+    Number of nodes in a document and the bytes held by its structure:
+    the nodes themselves, their lists of children and their attribute
+    maps, but not the text.
+    """
+    nodes = 0
+    size = 0
+    pending = [doc]
+    while pending:
+        node = pending.pop()
+        nodes += 1
+        size += sys.getsizeof(node)
+        if node._children is not None:
+            size += sys.getsizeof(node._children)
+            pending.extend(node._children)
+        attr = getattr(node, "_attr", None)
+        if attr is not None:
+            size += sys.getsizeof(attr)
+            for part in (attr.classes, attr.styles, attr.map):
+                if part is not None:
+                    size += sys.getsizeof(part)
+    return nodes, size
+
+def measureDom(source, context=None):
+    """
+    Memory used by the document tree parsed from source.  "bytes" is
+    the footprint of the tree's structure from domFootprint(); where
+    the tracemalloc module is available, "traced" is the peak memory
+    allocated while parsing (otherwise it is None).
+
+    >>> import bench
+    >>> m = bench.measureDom(bench.manualCorpus(2))
+    >>> m["nodes"] > 1000
+    True
+    >>> m["bytes"] < 250 * m["nodes"]
+    True
+    """
+    out = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        if tracemalloc:
+            tracemalloc.start()
+        if context is not None:
+            context = context.copy()
+        doc = parser.MarkupParser(context=context).parse(
+            StringIO.StringIO(source))
+        if tracemalloc:
+            traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            traced = None
+    finally:
+        sys.stdout = out
+
+    nodes, size = domFootprint(doc)
+    return { "nodes": nodes, "bytes": size, "traced": traced }
+
+def measureIsolated(name, scale, repeat=3):
+    """
+    Like measure(), but in a child process of its own.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure, (name, scale, repeat))
+    finally:
+        pool.close()
+        pool.join()
+
+def runSuite(scales=(1, 4, 16), names=None, repeat=3):
+    """
+    Measure every corpus (or those named) at every scale, returning
+    a map of "corpus/scale" keys to the results of measure().
+    """
+    results = {}
+    for name, f in corpora:
+        if names and not name in names:
+            continue
+        for scale in scales:
+            results["%s/%d" % (name, scale)] = measureIsolated(name, scale, repeat)
+    return results
+
+def compareBaseline(results, baseline, threshold=0.25):
+    """
+    List the regressions in results relative to a baseline: cases
+    whose total time, peak memory or document size grew by more than
+    the threshold fraction.  Cases or figures missing from either side
+    are ignored.
+
+    >>> import bench
+    >>> old = { "a/1": { "seconds": 1.0, "peakMemory": 1000 } }
+    >>> new = { "a/1": { "seconds": 1.2, "peakMemory": 1500 } }
+    >>> bench.compareBaseline(new, old)
+    ['a/1: peakMemory 1000 -> 1500 (+50%)']
+    >>> bench.compareBaseline(new, old, 0.1)
+    ['a/1: peakMemory 1000 -> 1500 (+50%)', 'a/1: seconds 1 -> 1.2 (+20%)']
+    """
+    regressions = []
+    for key in sorted(results):
+        if not key in baseline:
+            continue
+        for field in ("domBytes", "peakMemory", "seconds"):
+            if not (field in baseline[key] and field in results[key]):
+                continue
+            old, new = baseline[key][field], results[key][field]
+            if old > 0 and new > old * (1.0 + threshold):
+                regressions.append("%s: %s %.4g -> %.4g (+%d%%)" % (key,
+                    field, old, new, round(100.0 * (new - old) / old)))
+    return regressions
+
+def printResults(results):
+    print "%-14s %7s %9s %11s %11s %9s %9s" % ("case", "lines", "seconds",
+        "lines/s", "bytes/s", "peak KB", "dom KB")
+    for key in sorted(results):
+        r = results[key]
+        print "%-14s %7d %9.3f %11.0f %11.0f %9d %9d" % (key, r["lines"],
+            r["seconds"], r["linesPerSecond"], r["bytesPerSecond"],
+            r["peakMemory"], r["domBytes"] / 1024)
+    print
+    phases = instrument.phases
+    print "%-14s" % "case", " ".join("%9s" % p[:9] for p in phases)
+    for key in sorted(results):
+        t = results[key]["phases"]
+        print "%-14s" % key, " ".join("%9.4f" % t[p] for p in phases)
+
+def main(argv=None):
+    """
+    Run the suite and print the results.  With --save, also write them
+    to a JSON file; with --baseline, compare them against such a file
+    and exit with status 1 if anything regressed past --threshold.
+    """
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] [corpus ...]")
+    op.add_option("--scales", default="1,4,16",
+        help="comma-separated corpus scales [%default]")
+    op.add_option("--repeat", type="int", default=3,
+        help="runs per case, best time kept [%default]")
+    op.add_option("--save", metavar="FILE", help="write results as JSON")
+    op.add_option("--baseline", metavar="FILE",
+        help="compare results against this JSON file")
+    op.add_option("--threshold", type="float", default=0.25,
+        help="allowed fractional slowdown or growth [%default]")
+    op.add_option("--inline", action="store_true",
+        help="also time the inline pass on single long paragraphs")
+    op.add_option("--scan", action="store_true",
+        help="also compare scanning with converting")
+    options, names = op.parse_args(argv)
+
+    scales = [int(s) for s in options.scales.split(",")]
+    results = runSuite(scales, names, options.repeat)
+    printResults(results)
+    if options.inline:
+        print
+        benchInline()
+    if options.scan:
+        print
+        benchScan(max(scales), names)
+
+    if options.save:
+        f = open(options.save, "w")
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compareBaseline(results, baseline, options.threshold)
+        print
+        for r in regressions:
+            print "REGRESSION", r
+        if regressions:
+            return 1
+        print "No regressions past %d%%." % round(100 * options.threshold)
+    return 0
+
+# End of code
+
+if __name__ == "__main__":
+    if "--doctest" in sys.argv:
+        import doctest
+        doctest.testmod()
+    else:
+        sys.exit(main())
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+"""
+build.py: A module from EWC (http://piclab.com/ewc/).
+
+Building a site: converting a tree of source files to a parallel tree
+of HTML files, rebuilding only what has changed.  Each build leaves a
+manifest recording, for every page, the state (modification time,
+size and content hash) of its source file and of every file it
+included, directly or through other includes (so
+includes whose names come from variables are covered too, as the
+files actually read are what is recorded).  The next build re-renders
+a page only if one of those files has changed or disappeared, if its
+output has been changed or removed, if the page is new, or if the
+settings affecting output are different.  Outputs are written to a
+temporary file and renamed into place.  scripts/ewc2html is the
+command-line interface to this.
+
+>>> import build, os, tempfile
+>>> src, out = tempfile.mkdtemp(), tempfile.mkdtemp()
+>>> def write(name, text):
+...     f = open(os.path.join(src, name), "w"); f.write(text); f.close()
+>>> write("head.inc", "Header $$title$$\\n")
+>>> write("a.ewc", "<<include head.inc\\ntitle=A\\n>>\\nPage A.\\n")
+>>> write("b.ewc", "Page B.\\n")
+>>> b = build.Builder(src, out, includePath=src)
+>>> b.build()
+['a.ewc', 'b.ewc']
+>>> b.manifest.dependents(os.path.join(src, "head.inc"))
+['a.ewc']
+>>> build.Builder(src, out, includePath=src).build()
+[]
+>>> write("head.inc", "New header $$title$$\\n")
+>>> b = build.Builder(src, out, includePath=src)
+>>> b.build()
+['a.ewc']
+>>> print open(os.path.join(out, "a.html")).read()
+<BLANKLINE>
+<div>
+<p>New header A
+Page A.</p></div>
+
+Touching a file without changing it, or removing an output, is
+noticed, and pages can be built by a pool of worker processes:
+
+>>> os.utime(os.path.join(src, "b.ewc"), (0, 0))
+>>> os.remove(os.path.join(out, "a.html"))
+>>> build.Builder(src, out, includePath=src).build(jobs=2)
+['a.ewc']
+
+Any change to the context's settings, handlers or page index makes
+every page stale:
+
+>>> import config
+>>> c = config.parsingContext.copy()
+>>> c.localLinkPattern = "/wiki/%s"
+>>> build.Builder(src, out, includePath=src, context=c).build()
+['a.ewc', 'b.ewc']
+>>> build.Builder(src, out, includePath=src, context=c).build()
+[]
+
+Worker processes build with the same context:
+
+>>> write("b.ewc", "[[Page]]\\n")
+>>> build.Builder(src, out, includePath=src, context=c).build(jobs=2)
+['b.ewc']
+>>> print open(os.path.join(out, "b.html")).read()
+<BLANKLINE>
+<div>
+<p>
+<a href="/wiki/page">Page</a></p></div>
+"""
+
+import os, errno, json, hashlib, tempfile, traceback, multiprocessing
+
+# relative imports
+import config, extensions, parser, dom, batch
+
+def stamp(name):
+    """
+    Quick check of whether a file has changed: its modification time
+    and size, or None if it doesn't exist.
+    """
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def fileHash(name):
+    h = hashlib.sha1()
+    f = open(name, "rb")
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def fileState(name):
+    """
+    Stamp of a file with the hash of its contents added, or None if
+    it doesn't exist.
+    """
+    s = stamp(name)
+    if s is None:
+        return None
+    return s + [fileHash(name)]
+
+def unchanged(state, name):
+    """
+    True if file name still has the given state.  The contents are
+    hashed only if the stamp differs, and if they turn out to be the
+    same (the file was touched, or copied back) the stamp in state is
+    brought up to date so they aren't hashed again.
+    """
+    s = stamp(name)
+    if s is None or state is None:
+        return s is None and state is None
+    if s == state[:2]:
+        return True
+    try:
+        if fileHash(name) != state[2]:
+            return False
+    except IOError:
+        return False
+    state[:2] = s
+    return True
+
+def writeAtomically(name, write):
+    """
+    Call write with a file object for a temporary file next to name,
+    and rename it to name when done, so that readers never see a
+    partly written file and a failed write leaves the old one.
+    """
+    d = os.path.dirname(os.path.abspath(name))
+    try:
+        os.makedirs(d)
+    except OSError, e:
+        if errno.EEXIST != e.errno:
+            raise
+    fd, temp = tempfile.mkstemp(dir=d)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            write(f)
+        finally:
+            f.close()
+        os.rename(temp, name)
+    except:
+        os.remove(temp)
+        raise
+
+class Manifest(object):
+    """
+    Record of the last build, kept in a JSON file.  For each page (by
+    path relative to the source directory) there is the state of its
+    source, the stamp of its output, and a list of [path, state] for
+    each file it included.
+    """
+    version = 2
+
+    def __init__(self, path=None):
+        object.__init__(self)
+        self.path = path
+        self.settings = None
+        self.pages = {}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        f = open(self.path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        if Manifest.version == data.get("version"):
+            self.settings = data["settings"]
+            self.pages = data["pages"]
+
+    def save(self):
+        data = { "version": Manifest.version, "settings": self.settings,
+            "pages": self.pages }
+        writeAtomically(self.path,
+            lambda f: f.write(json.dumps(data, sort_keys=True)))
+
+    def record(self, page, source, output, includes):
+        """
+        Note that page was just built from a source in state source,
+        to an output with stamp output, reading the included files
+        (path, state) in includes.
+        """
+        self.pages[page] = {
+            "source": source,
+            "output": output,
+            "includes": [list(i) for i in includes],
+        }
+
+    def stale(self, page, source, output):
+        """
+        True if page must be rebuilt from file source to file output.
+        """
+        entry = self.pages.get(page)
+        if entry is None or entry["output"] != stamp(output):
+            return True
+        if not unchanged(entry["source"], source):
+            return True
+        for name, state in entry["includes"]:
+            if not unchanged(state, name):
+                return True
+        return False
+
+    def dependents(self, name):
+        """
+        Pages that included file name when last built.
+        """
+        return sorted(page for page, entry in self.pages.iteritems()
+            if name in [n for n, s in entry["includes"]])
+
+    def forget(self, pages):
+        """
+        Drop all pages not in pages (such as those whose sources have
+        been removed).
+        """
+        pages = set(pages)
+        for page in self.pages.keys():
+            if not page in pages:
+                del self.pages[page]
+
+def buildContext(context=None, includePath=None):
+    """
+    Copy of context (or of the global parsingContext) for building,
+    with includes from includePath if given.
+    """
+    context = (context or config.parsingContext).copy()
+    if includePath is not None:
+        context.includePath = includePath
+        if not u"include" in context.extensionHandlers:
+            context.addExtension(u"include", extensions.IncludeFile())
+    return context
+
+def renderPage(context, hd, source, output):
+    """
+    Convert file source to HTML file output, returning the state of
+    the source as read, the stamp of the output, and (path, state)
+    for each file included.
+    """
+    state = fileState(source)
+    p = parser.MarkupParser(context=context.copy())
+    f = open(source)
+    try:
+        doc = p.parse(f)
+    finally:
+        f.close()
+    includes = [(name, fileState(name)) for name in p.context.includes]
+
+    writer = dom.HTMLWriter(hd, context=p.context)
+    writeAtomically(output, lambda f: writer.write(doc, f))
+    return state, stamp(output), includes
+
+# Settings for the pages built by a worker process
+worker = {}
+
+def installWorker(settings, context, includePath, hd):
+    batch.installSettings(settings)
+    worker["context"] = buildContext(context, includePath)
+    worker["hd"] = hd
+
+def buildTask(task):
+    """
+    Worker function: build one (page, source, output) task.
+    """
+    page, source, output = task
+    try:
+        return page, renderPage(worker["context"], worker["hd"], source,
+            output), None
+    except Exception:
+        return page, None, traceback.format_exc()
+
+class Builder(object):
+    """
+    Convert every file ending in suffix under directory source to a
+    file ending in .html at the same place under directory output.
+    The manifest is kept in output unless manifestPath is given.
+    """
+    def __init__(self, source, output, includePath=None, hd=0,
+        suffix=".ewc", manifestPath=None, context=None):
+        object.__init__(self)
+        self.source = source
+        self.output = output
+        self.includePath = includePath
+        self.hd = hd
+        self.suffix = suffix
+        self.context = buildContext(context, includePath)
+        if manifestPath is None:
+            manifestPath = os.path.join(output, ".ewc-manifest")
+        self.manifest = Manifest(manifestPath)
+        self.errors = {}
+
+    def settingsKey(self):
+        """
+        Everything in the build's context that affects output (see
+        config.ParsingContext.settingsKey()), or None if that can't be
+        told, in which case every build rebuilds every page.
+        """
+        key = self.context.settingsKey()
+        if key is None:
+            return None
+        return repr((self.hd, key))
+
+    def settingsChanged(self):
+        key = self.settingsKey()
+        return key is None or self.manifest.settings != key
+
+    def pages(self):
+        """
+        Paths of the source files relative to the source directory.
+        """
+        found = []
+        for d, dirs, files in os.walk(self.source):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith(self.suffix):
+                    found.append(os.path.relpath(os.path.join(d, f),
+                        self.source))
+        return found
+
+    def sourcePath(self, page):
+        return os.path.join(self.source, page)
+
+    def outputPath(self, page):
+        return os.path.join(self.output, page[:-len(self.suffix)] + ".html")
+
+    def stalePages(self, force=False):
+        pages = self.pages()
+        if force or self.settingsChanged():
+            return pages
+        return [page for page in pages if self.manifest.stale(page,
+            self.sourcePath(page), self.outputPath(page))]
+
+    def results(self, tasks, jobs, chunksize=4):
+        if 1 == jobs:
+            for page, source, output in tasks:
+                try:
+                    yield page, renderPage(self.context, self.hd, source,
+                        output), None
+                except Exception:
+                    yield page, None, traceback.format_exc()
+            return
+
+        pool = multiprocessing.Pool(jobs, installWorker,
+            (batch.currentSettings(self.context), self.context,
+            self.includePath, self.hd))
+        try:
+            for r in pool.imap_unordered(buildTask, tasks, chunksize):
+                yield r
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def build(self, force=False, jobs=1):
+        """
+        Rebuild the pages that need it (or all of them, if force is
+        true), using jobs worker processes (one per CPU if None), and
+        save the manifest.  Returns the pages rebuilt; those that
+        failed are left out of the manifest so that they are tried
+        again next time, and their errors are kept in self.errors.
+        """
+        stale = self.stalePages(force)
+        if self.settingsChanged():
+            self.manifest.pages = {}
+            self.manifest.settings = self.settingsKey()
+
+        self.errors = {}
+        built = []
+        tasks = [(page, self.sourcePath(page), self.outputPath(page))
+            for page in stale]
+        try:
+            for page, result, error in self.results(tasks, jobs):
+                if error is None:
+                    self.manifest.record(page, *result)
+                    built.append(page)
+                else:
+                    self.manifest.pages.pop(page, None)
+                    self.errors[page] = error
+        finally:
+            self.manifest.forget(self.pages())
+            self.manifest.save()
+        return sorted(built)
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
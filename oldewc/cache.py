@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+cache.py: A module from EWC (http://piclab.com/ewc/).
+
+Caching rendered HTML so that unchanged documents are not parsed
+again.  Renderings are stored under a hash of the source text and of
+every setting of the parsing context that affects the output, in a
+bounded in-memory LRU table and, optionally, in a size-bounded
+directory on disk.  Each is stored with the modification times and
+sizes of the files the document included, and is not used once any
+of them has changed.
+"""
+
+import os, errno, json, hashlib, tempfile, threading
+from collections import OrderedDict
+
+# relative imports
+import config, parser
+
+class RenderCache(object):
+    """
+    Cache of convertString() results.
+
+    >>> import cache
+    >>> rc = cache.RenderCache(maxEntries=2)
+    >>> html = rc.convert(u"Some **bold** text.")
+    >>> html == rc.convert(u"Some **bold** text.")
+    True
+    >>> x = rc.convert(u"Two"), rc.convert(u"Three")
+    >>> sorted(rc.stats().items())
+    [('diskEvictions', 0), ('diskHits', 0), ('evictions', 1), ('hits', 1), ('misses', 3)]
+
+    Settings are those of the context given, or of the global context:
+
+    >>> import config, pageindex
+    >>> c = config.parsingContext.copy()
+    >>> c.pageIndex = pageindex.SetIndex()
+    >>> rc.convert(u"[[New Page]]", context=c).count(u"missing")
+    1
+    >>> c.pageIndex.add([u"New Page"])
+    >>> rc.convert(u"[[New Page]]", context=c).count(u"missing")
+    0
+    >>> c.localLinkPattern = "/wiki/%s"
+    >>> print rc.convert(u"[[New Page]]", context=c).split("\\n")[-1]
+    <a href="/wiki/new_page">New Page</a></p></div>
+    """
+    def __init__(self, maxEntries=1000, directory=None, maxBytes=64*1024*1024):
+        object.__init__(self)
+        self.maxEntries = maxEntries
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.diskHits = 0
+        self.diskEvictions = 0
+        self.diskBytes = None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "diskHits": self.diskHits,
+            "diskEvictions": self.diskEvictions,
+        }
+
+    def settingsKey(self, hd, context=None):
+        """
+        Everything besides the source text that affects the HTML made
+        with context (or the global context), or None if that can't be
+        told and the rendering should not be cached.
+        """
+        key = (context or config.parsingContext).settingsKey()
+        if key is None:
+            return None
+        return repr((hd, key))
+
+    def key(self, ins, hd=0, context=None):
+        settings = self.settingsKey(hd, context)
+        if settings is None:
+            return None
+        if isinstance(ins, unicode):
+            ins = ins.encode("utf-8")
+        h = hashlib.sha1(settings)
+        h.update("\0")
+        h.update(ins)
+        return h.hexdigest()
+
+    def convert(self, ins, hd=0, context=None):
+        """
+        Same as parser.convertString(), but taken from the cache if the
+        same text has been rendered with the same settings before, and
+        the files it included haven't changed since.
+        """
+        context = context or config.parsingContext
+        key = self.key(ins, hd, context)
+        if key is not None:
+            html = self.get(key)
+            if html is not None:
+                return html
+
+        c = context.copy()
+        html = parser.convertString(ins, hd, c)
+        if key is not None:
+            self.put(key, html, [(name, stamp(name)) for name in c.includes])
+        return html
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if fresh(entry[1]):
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[0]
+                self.evictions += 1
+
+        entry = self.diskGet(key)
+        if entry is not None and not fresh(entry[1]):
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.diskHits += 1
+            self.memoryPut(key, entry)
+        return entry[0]
+
+    def put(self, key, html, includes=()):
+        """
+        Store html under key, along with (path, stamp) for each file
+        included in making it.
+        """
+        entry = (html, [[name, s] for name, s in includes])
+        with self.lock:
+            self.memoryPut(key, entry)
+        self.diskPut(key, entry)
+
+    def memoryPut(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    #
+    # On-disk tier: one file per rendering, named by its key, holding
+    # a line of JSON listing the included files and then the HTML in
+    # UTF-8.  Access times are tracked through file modification
+    # times, so several processes can share one directory.
+    #
+    def diskPath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def diskGet(self, key):
+        if self.directory is None:
+            return None
+        name = self.diskPath(key)
+        try:
+            f = open(name, "rb")
+            try:
+                includes = json.loads(f.readline())
+                html = f.read().decode("utf-8")
+            finally:
+                f.close()
+            os.utime(name, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return html, includes
+
+    def diskPut(self, key, entry):
+        if self.directory is None:
+            return
+        name = self.diskPath(key)
+        html, includes = entry
+        data = json.dumps(includes) + "\n" + html.encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(name))
+        except OSError, e:
+            if errno.EEXIST != e.errno:
+                raise
+
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(name))
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(temp, name)
+
+        with self.lock:
+            if self.diskBytes is None:
+                self.diskBytes = sum(size for n, m, size in self.diskFiles())
+            else:
+                self.diskBytes += len(data)
+            if self.diskBytes > self.maxBytes:
+                self.diskEvict()
+
+    def diskFiles(self):
+        """
+        (name, mtime, size) for every cached rendering on disk.
+        """
+        for sub in os.listdir(self.directory):
+            d = os.path.join(self.directory, sub)
+            if not os.path.isdir(d):
+                continue
+            for f in os.listdir(d):
+                name = os.path.join(d, f)
+                try:
+                    st = os.stat(name)
+                except OSError:
+                    continue
+                yield name, st.st_mtime, st.st_size
+
+    def diskEvict(self):
+        """
+        Remove least recently used files until the directory is back
+        under three quarters of its limit, so that eviction scans of
+        the directory happen only now and then.
+        """
+        files = sorted(self.diskFiles(), key=lambda f: f[1])
+        total = sum(f[2] for f in files)
+        for name, mtime, size in files:
+            if total <= (self.maxBytes * 3) // 4:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            total -= size
+            self.diskEvictions += 1
+        self.diskBytes = total
+
+def stamp(name):
+    """
+    Modification time and size of file name, or None if it is missing.
+    """
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def fresh(includes):
+    """
+    True if none of the files in includes, a list of [path, stamp],
+    has changed.
+    """
+    for name, s in includes:
+        if stamp(name) != s:
+            return False
+    return True
+
+defaultCache = RenderCache()
+
+def convertString(ins, hd=0, context=None):
+    """
+    Cached version of parser.convertString(), using defaultCache.
+    """
+    return defaultCache.convert(ins, hd, context)
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
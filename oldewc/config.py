@@ -5,6 +5,8 @@ config.py: A module from EWC (http://piclab.com/ewc/).
 Configuration variables for various EWC modules and functions.
 """
 
+import threading
+
 # Input encoding to assume if unknown
 inputEncoding = "ascii"
 
@@ -20,32 +22,148 @@ localImagePattern = "/images/%s"
 # Compact or readable HTML output
 compactHTML = False
 
+# Extra characters to write as named entities in HTML text, mapped to
+# the entity names, e.g. { u"\u2026": u"hellip" }
+htmlEntities = {}
+
+# Write the non-ASCII entities as numeric character references
+numericEntities = False
+
+# Class added to links to local pages not in the context's pageIndex
+missingPageClass = "missing"
+
 # Path to find included files: None supresses includes
 includePath = None
 
 # Include recursion depth at which to error out
 includeDepthLimit = 20
 
+# Nesting depth of divisions, lists, and inline markup at which to error out
+nestingDepthLimit = 1000
+
+# Version of the rendered output; change it whenever the HTML produced
+# for some input changes, so that cached renderings are not reused
+renderVersion = 1
+
 standardURISchemes = (
     u"acap", u"cap", u"cid", u"data", u"dav", u"dict", u"fax",
     u"file", u"ftp", u"http", u"https", u"im", u"imap", u"info", u"ldap", u"mailto",
     u"mid", u"news", u"nfs", u"nntp", u"pop", u"snmp", u"telnet",
 )
 
+# Settings above that a ParsingContext can override for its own parses
+contextSettings = ( "inputEncoding", "outputEncoding", "localLinkPattern",
+    "localImagePattern", "compactHTML", "htmlEntities", "numericEntities", "missingPageClass",
+    "includePath", "includeDepthLimit",
+    "nestingDepthLimit", )
+
 class ParsingContext(object):
+    """
+    Settings and registries for parsing.  Each MarkupParser gets its
+    own copy of the global parsingContext below, so changes made to one
+    parser's context don't affect parses in other threads.  Any of the
+    settings named in contextSettings that hasn't been assigned on the
+    context reads through to the module variable of the same name.
+
+    >>> import config
+    >>> c = config.parsingContext.copy()
+    >>> c.localLinkPattern == config.localLinkPattern
+    True
+    >>> c.localLinkPattern = "/wiki/%s"
+    >>> config.localLinkPattern
+    '/w/%s.html'
+    >>> c.copy().localLinkPattern
+    '/wiki/%s'
+    """
     def __init__(self):
+        object.__init__(self)
         self.quotesAndDashes = True
         self.emAndStrong = False
         self.nakedURLs = False
 
         self.namespaceHandlers = {}
         self.extensionHandlers = {}
+        self.lock = threading.RLock()
+
+        # Instrumentation sink (see instrument.py), or None
+        self.sink = None
+
+        # Index of existing pages (see pageindex.py), or None
+        self.pageIndex = None
 
         self.doc = None
 
+        # Paths of the files included by the document being parsed,
+        # directly or by other included files, in order of inclusion
+        self.includes = None
+
+    def __getattr__(self, name):
+        if name in contextSettings:
+            return globals()[name]
+        raise AttributeError(name)
+
+    def copy(self):
+        """
+        New context with the same settings and handlers, and its own
+        registries, which can be changed independently of this one.
+        """
+        self.lock.acquire()
+        try:
+            c = ParsingContext()
+            for k, v in self.__dict__.iteritems():
+                if not k in ("lock", "doc", "includes"):
+                    setattr(c, k, v)
+            c.namespaceHandlers = dict(self.namespaceHandlers)
+            c.extensionHandlers = dict(self.extensionHandlers)
+            return c
+        finally:
+            self.lock.release()
+
+    def settingsKey(self):
+        """
+        Everything in this context that affects the HTML produced, as
+        a string for the keys of cached renderings, or None if that
+        can't be told (the pageIndex has no version() method).
+
+        >>> import config, pageindex
+        >>> c = config.parsingContext.copy()
+        >>> key = c.settingsKey()
+        >>> c.localLinkPattern = "/wiki/%s"
+        >>> c.settingsKey() == key
+        False
+        >>> c.pageIndex = pageindex.SetIndex()
+        >>> key = c.settingsKey()
+        >>> c.pageIndex.add([u"Page"])
+        >>> c.settingsKey() == key
+        False
+        """
+        index = self.pageIndex
+        version = None
+        if index is not None:
+            if not hasattr(index, "version"):
+                return None
+            version = index.version()
+
+        settings = []
+        for name in contextSettings:
+            value = getattr(self, name)
+            if isinstance(value, dict):
+                value = sorted(value.items())
+            settings.append((name, value))
+        handlers = []
+        for table in (self.namespaceHandlers, self.extensionHandlers):
+            handlers.append(sorted((name, h.__class__.__module__,
+                h.__class__.__name__) for name, h in table.iteritems()))
+        return repr((renderVersion, settings, self.quotesAndDashes,
+            self.emAndStrong, self.nakedURLs, handlers, version))
+
     def addNamespace(self, name, handler):
         assert isinstance(name, unicode)
-        self.namespaceHandlers[name] = handler
+        self.lock.acquire()
+        try:
+            self.namespaceHandlers[name] = handler
+        finally:
+            self.lock.release()
 
     def getNamespace(self, name):
         try:
@@ -55,8 +173,12 @@ class ParsingContext(object):
 
     def addExtension(self, name, handler):
         assert isinstance(name, unicode)
-        self.extensionHandlers[name] = handler
-        
+        self.lock.acquire()
+        try:
+            self.extensionHandlers[name] = handler
+        finally:
+            self.lock.release()
+
     def getExtension(self, name):
         try:
             return self.extensionHandlers[name]
@@ -64,3 +186,22 @@ class ParsingContext(object):
             return self.extensionHandlers[u""]
 
 parsingContext = ParsingContext()
+
+_active = threading.local()
+
+def currentContext():
+    """
+    The context of the parser running in this thread, or the global
+    parsingContext if none is.  Namespace handlers, extensions, and
+    the HTML visitor get their settings from here.
+    """
+    return getattr(_active, "context", None) or parsingContext
+
+def activate(context):
+    """
+    Make context current in this thread, returning the one it
+    replaces, which should be passed back here when done.
+    """
+    previous = getattr(_active, "context", None)
+    _active.context = context
+    return previous
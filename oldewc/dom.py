@@ -9,7 +9,6 @@ The module defines the dom, and contains HTML output functions.
 """
 
 import re
-from xml.sax.saxutils import escape as xmlescape, quoteattr as xmlquoteattr
 
 # relative imports
 import config
@@ -19,17 +18,39 @@ class DomError(Exception): pass
 class NestingError(DomError): pass
 class StyleFormatError(DomError): pass
 
+internLimit = 10000
+interned = {}
+
+def intern(name):
+    """
+    Shared copy of a class name or attribute key, so that the many
+    elements using the same names don't each hold their own.  Only
+    the first internLimit distinct names are kept.
+    """
+    try:
+        return interned[name]
+    except KeyError:
+        if len(interned) < internLimit:
+            interned[name] = name
+        return name
+
 class Node(object):
     """
     Basic DOM node. Abstract class handles the containment and tree-structure
     stuff; specific node behaviors are handled by concrete subclasses.
+
+    Nodes are numerous, so they have no __dict__, and the list of
+    children is only allocated when the first child is added; until
+    then children is an empty tuple.
     """
+    __slots__ = ("parent", "_children")
+    allowed_contents = ()
+
     def __init__(self, parent=None):
         if self.__class__ is Node:
             raise NotImplementedError
         object.__init__(self)
-        self.allowed_contents = tuple()
-        self.children = []
+        self._children = None
 
         self.parent = parent
         if parent is not None:
@@ -42,34 +63,67 @@ class Node(object):
         else:
             raise NestingError(self, node)
 
+    def _getchildren(self):
+        if self._children is None:
+            return ()
+        return self._children
+    def _setchildren(self, children):
+        self._children = children or None
+    children = property(_getchildren, _setchildren)
+
     def __len__(self):
-        return len(self.children)
+        if self._children is None:
+            return 0
+        return len(self._children)
+    def __iter__(self):
+        return iter(self._children or ())
     def __getitem__(self, key):
-        return self.children[key]
+        return (self._children or ())[key]
     def __delitem__(self, key):
-        del self.children[key]
+        if self._children is None:
+            raise IndexError(key)
+        del self._children[key]
     def __setitem__(self, key, child):
-        self.children[key] = self._ok_to_add(child)
+        if self._children is None:
+            raise IndexError(key)
+        self._children[key] = self._ok_to_add(child)
     def append(self, child):
-        self.children.append(self._ok_to_add(child))
+        if self._children is None:
+            self._children = [self._ok_to_add(child)]
+        else:
+            self._children.append(self._ok_to_add(child))
     def extend(self, v):
         for c in v: self.append(c)
     def index(self, child, i=0, j=None):
         if j is None: return self.children.index(child, i)
         else: return self.children.index(child, i, j)
     def insert(self, i, child):
-        self.children.insert(i, self._ok_to_add(child))
+        if self._children is None:
+            self._children = []
+        self._children.insert(i, self._ok_to_add(child))
     def pop(self, i=-1):
-        return self.children.pop(i)
+        if self._children is None:
+            raise IndexError("pop from empty list")
+        return self._children.pop(i)
     def remove(self, node):
-        self.children.remove(node)
+        if self._children is None:
+            raise ValueError("remove(x): x not in list")
+        self._children.remove(node)
 
     def normalize(self):
         """
         Clean up things like adjacent text nodes, empty text nodes,
         whitespace-only nodes in containers like Divisions, Tables, and such,
         and spans with single elements.
+        The tree is walked with an explicit stack rather than recursively.
         """
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            node._normalize_children()
+            pending.extend(reversed(node.children))
+
+    def _normalize_children(self):
         self.children = [c for c in self if not (isinstance(c, Text) and c.isempty())]
         if isinstance(self, (Division, Table, TableRow, BaseList)):
             self.children = [c for c in self if not (isinstance(c, Text) and c.isspace())]
@@ -92,50 +146,56 @@ class Node(object):
             self.parent[self.parent.index(self)] = self[0]
             __pychecker__ = ""
 
-        for n in self: n.normalize()
-
     def dump(self, level=0):
         """
         Used for debugging and testing.
         """
-        prefix = " _" * level if level else ""
-        if isinstance(self, Text):
-            __pychecker__ = "no-classattr"
-            size = len(self.value)
-            __pychecker__ = ""
-        else:
-            size = len(self)
+        pending = [(self, level)]
+        while pending:
+            node, level = pending.pop()
+            prefix = " _" * level if level else ""
+            if isinstance(node, Text):
+                __pychecker__ = "no-classattr"
+                size = len(node.value)
+                __pychecker__ = ""
+            else:
+                size = len(node)
 
-        if isinstance(self, Element):
-            try:
-                cl = "[%s]" % self.attr.classval()
-            except KeyError:
-                cl = "[]"
-        else:
-            cl = ""
+            if isinstance(node, Element):
+                try:
+                    cl = "[%s]" % node.attr.classval()
+                except KeyError:
+                    cl = "[]"
+            else:
+                cl = ""
 
-        print prefix, self.__class__.__name__, ("%s (%d)" % (cl, size))
-        for n in self:
-            n.dump(level+1)
+            print prefix, node.__class__.__name__, ("%s (%d)" % (cl, size))
+            pending.extend((n, level+1) for n in reversed(node.children))
 
 class AttributeMap(object):
     """
     Maintain element attributes. Styles and classes are treated
     specially so that they can be tested separately and aggregated
     reasonably efficiently.  Keys are ASCII text, values are Unicode.
+    The class list and the style and attribute dicts are created when
+    first needed; an unused one is None.
     """
+    __slots__ = ("classes", "styles", "map")
+
     def __init__(self):
         object.__init__(self)
-        self.classes = []
-        self.styles = {}
-        self.map = {}
+        self.classes = None
+        self.styles = None
+        self.map = None
 
     def addClass(self, name):
-        if not (self.classes and name in self.classes):
-            self.classes.append(name)
+        if self.classes is None:
+            self.classes = [intern(name)]
+        elif not name in self.classes:
+            self.classes.append(intern(name))
 
     def hasClass(self, name):
-        return name in self.classes
+        return bool(self.classes) and name in self.classes
 
     def removeClass(self, name):
         if self.classes and name in self.classes:
@@ -148,26 +208,38 @@ class AttributeMap(object):
             raise StyleFormatError(style)
         p, v = m.groups()
         v = v.rstrip("; \t\n")
-        self.styles[p] = v.decode()
+        self._set_style(p, v.decode())
+
+    def _set_style(self, property, value):
+        if self.styles is None:
+            self.styles = {}
+        self.styles[intern(property)] = value
 
     def hasStyle(self, property):
-        return property in self.styles
+        return bool(self.styles) and property in self.styles
 
     def removeStyle(self, property):
-        if property in self.styles:
+        if self.styles and property in self.styles:
             self.styles.pop(property)
 
     def merge(self, newmap):
         """
         Merge attributes of another element, overriding ours.
         """
-        for c in newmap.classes:
+        for c in newmap.classes or ():
             self.addClass(c)
-        self.styles.update(newmap.styles)
-        self.map.update(newmap.map)
+        if newmap.styles:
+            if self.styles is None:
+                self.styles = {}
+            self.styles.update(newmap.styles)
+        if newmap.map:
+            if self.map is None:
+                self.map = {}
+            self.map.update(newmap.map)
 
     def __len__(self):
-        n = len(self.map)
+        n = 0
+        if self.map: n += len(self.map)
         if self.styles: n += 1
         if self.classes: n += 1
         return n
@@ -188,16 +260,18 @@ class AttributeMap(object):
     def __getitem__(self, key):
         if "class" == key: return self.classval()
         elif "style" == key: return self.styleval()
+        elif self.map is None: raise KeyError(key)
         else: return self.map[key]
 
     def __delitem__(self, key):
-        if "class" == key: self.classes = []
-        elif "style" == key: self.styles = []
+        if "class" == key: self.classes = None
+        elif "style" == key: self.styles = None
+        elif self.map is None: raise KeyError(key)
         else: del self.map[key]
 
     def __setitem__(self, key, val):
         if "class" == key:
-            self.classes = val.split(u" ")
+            self.classes = [intern(c) for c in val.split(u" ")]
         elif "style" == key:
             styles = val.split(u";")
             for s in styles:
@@ -206,47 +280,50 @@ class AttributeMap(object):
                 spl = s.split(":", 1)
                 if 1 == len(spl):
                     spl.append("")
-                self.styles[spl[0].lstrip().rstrip()] = \
-                (spl[1].lstrip().rstrip()).decode()
+                self._set_style(spl[0].lstrip().rstrip(),
+                    (spl[1].lstrip().rstrip()).decode())
         else:
-            self.map[key] = makeUnicode(val)
+            if self.map is None:
+                self.map = {}
+            self.map[intern(key)] = makeUnicode(val)
 
     def __contains__(self, key):
-        if "class" == key: return 0 != len(self.classes)
-        elif "style" == key: return 0 != len(self.styles)
-        else: return key in self.map
+        if "class" == key: return bool(self.classes)
+        elif "style" == key: return bool(self.styles)
+        else: return bool(self.map) and key in self.map
 
     def clear(self):
-        self.classes = []
-        self.styles = []
-        self.map.clear()
+        self.classes = None
+        self.styles = None
+        self.map = None
 
     def items(self):
         r = []
         if self.classes: r.append(("class", self.classval()))
         if self.styles: r.append(("style", self.styleval()))
-        r.extend(self.map.items())
+        if self.map: r.extend(self.map.items())
         return r
 
     def keys(self):
         r = []
         if self.classes: r.append("class")
         if self.styles: r.append("style")
-        r.extend(self.map.keys())
+        if self.map: r.extend(self.map.keys())
         return r
 
     def values(self):
         r = []
         if self.classes: r.append(self.classval())
         if self.styles: r.append(self.styleval())
-        r.extend(self.map.values())
+        if self.map: r.extend(self.map.values())
         return r
 
     def _generate_items(self):
         if self.classes: yield ("class", self.classval())
         if self.styles: yield ("style", self.styleval())
-        for item in self.map.iteritems():
-            yield item
+        if self.map:
+            for item in self.map.iteritems():
+                yield item
 
     def iteritems(self):
         return self._generate_items()
@@ -254,8 +331,9 @@ class AttributeMap(object):
     def _generate_keys(self):
         if self.classes: yield "class"
         if self.styles: yield "style"
-        for key in self.map.iterkeys():
-            yield key
+        if self.map:
+            for key in self.map.iterkeys():
+                yield key
         
     def iterkeys(self):
         return self._generate_keys()
@@ -263,8 +341,9 @@ class AttributeMap(object):
     def _generate_values(self):
         if self.classes: yield self.classval()
         if self.styles: yield self.styleval()
-        for val in self.map.itervalues():
-            yield val
+        if self.map:
+            for val in self.map.itervalues():
+                yield val
         
     def itervalues(self):
         return self._generate_values()
@@ -296,13 +375,17 @@ class AttributeMap(object):
             return self.pop("class")
         elif self.styles:
             return self.pop("style")
-        else:
+        elif self.map:
             return self.map.popitem()
+        else:
+            raise KeyError("popitem(): attribute map is empty")
 
 class CharacterData(Node):
     """
     Carry some common functionality of Text and Comment nodes.
     """
+    __slots__ = ("_value",)
+
     def __init__(self, parent=None, val=u""):
         if self.__class__ is CharacterData:
             raise NotImplementedError
@@ -337,6 +420,8 @@ class CharacterData(Node):
     value = property(_getvalue, _setvalue)
 
 class Text(CharacterData):
+    __slots__ = ()
+
     def __init__(self, parent=None, val=u""):
         CharacterData.__init__(self, parent, val)
 
@@ -344,6 +429,8 @@ class Text(CharacterData):
         return visitor.onText(self)
 
 class Comment(CharacterData):
+    __slots__ = ()
+
     def __init__(self, parent=None, val=u""):
         CharacterData.__init__(self, parent, val)
 
@@ -356,12 +443,26 @@ class Element(Node):
     Class variables of node types are used only as temporary
     variables for various other code; any permanent attribute
     of a node should be placed in its attributes.
+    The AttributeMap is created on first access to attr.
     """
+    __slots__ = ("_attr",)
+
     def __init__(self, parent=None):
         if self.__class__ is Element:
             raise NotImplementedError
+        self._attr = None
         Node.__init__(self, parent)
-        self.attr = AttributeMap()
+
+    def _getattr(self):
+        if self._attr is None:
+            self._attr = AttributeMap()
+        return self._attr
+    def _setattr(self, attr):
+        self._attr = attr
+    attr = property(_getattr, _setattr)
+
+    def hasClass(self, name):
+        return self._attr is not None and self._attr.hasClass(name)
 
     def visit(self, visitor):
         return visitor.onElement(self)
@@ -373,6 +474,8 @@ class Element(Node):
             self[-1].addText(text)
 
 class InlineElement(Element):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         if self.__class__ is InlineElement:
             raise NotImplementedError
@@ -382,14 +485,18 @@ class InlineElement(Element):
         return visitor.onInlineElement(self)
 
 class Span(InlineElement):
+    __slots__ = ()
+    allowed_contents = (CharacterData, InlineElement)
+
     def __init__(self, parent=None):
         InlineElement.__init__(self, parent)
-        self.allowed_contents=(CharacterData, InlineElement)
 
     def visit(self, visitor):
         return visitor.onSpan(self)
 
 class Break(InlineElement):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         InlineElement.__init__(self, parent)
 
@@ -397,9 +504,10 @@ class Break(InlineElement):
         return visitor.onBreak(self)
 
 class Link(InlineElement):
+    __slots__ = ()
+
     def __init__(self, parent=None, addr=None):
         InlineElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, Span, Break, Image)
         if addr:
             self.attr["href"] = addr
 
@@ -407,6 +515,8 @@ class Link(InlineElement):
         return visitor.onLink(self)
 
 class Image(InlineElement):
+    __slots__ = ()
+
     def __init__(self, parent=None, addr=None):
         InlineElement.__init__(self, parent)
         if addr:
@@ -416,6 +526,8 @@ class Image(InlineElement):
         return visitor.onImage(self)
 
 class BlockElement(Element):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         if self.__class__ is BlockElement:
             raise NotImplementedError
@@ -425,17 +537,21 @@ class BlockElement(Element):
         return visitor.onBlockElement(self)
 
 class Division(BlockElement):
+    __slots__ = ()
+    allowed_contents = (CharacterData, BlockElement, InlineElement)
+
     def __init__(self, parent=None):
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, BlockElement, InlineElement)
 
     def visit(self, visitor):
         return visitor.onDivision(self)
 
 class Paragraph(BlockElement):
+    __slots__ = ()
+    allowed_contents = (CharacterData, InlineElement)
+
     def __init__(self, parent=None, type=None):
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, InlineElement)
         if type:
             self.attr["x-type"] = type
 
@@ -443,9 +559,11 @@ class Paragraph(BlockElement):
         return visitor.onParagraph(self)
 
 class Heading(BlockElement):
+    __slots__ = ()
+    allowed_contents = (CharacterData, Span, Break)
+
     def __init__(self, parent=None, level=1):
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, Span, Break)
         self.setLevel(level)
 
     def setLevel(self, level):
@@ -459,6 +577,8 @@ class Heading(BlockElement):
         return visitor.onHeading(self)
 
 class Rule(BlockElement):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BlockElement.__init__(self, parent)
 
@@ -466,16 +586,19 @@ class Rule(BlockElement):
         return visitor.onRule(self)
 
 class BaseList(BlockElement):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         if self.__class__ is BaseList:
             raise NotImplementedError
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, ListItem, InlineElement)
 
     def visit(self, visitor):
         return visitor.onBaseList(self)
 
 class UnorderedList(BaseList):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseList.__init__(self, parent)
 
@@ -483,6 +606,8 @@ class UnorderedList(BaseList):
         return visitor.onUnorderedList(self)
 
 class OrderedList(BaseList):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseList.__init__(self, parent)
 
@@ -490,24 +615,29 @@ class OrderedList(BaseList):
         return visitor.onOrderedList(self)
 
 class DictionaryList(BaseList):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseList.__init__(self, parent)
-        self.allowed_contents = (CharacterData, DictionaryTerm, DictionaryDef, InlineElement)
 
     def visit(self, visitor):
         return visitor.onDictionaryList(self)
 
 class BaseListItem(BlockElement):
+    __slots__ = ()
+    allowed_contents = (CharacterData, Paragraph, Rule, BaseList, InlineElement)
+
     def __init__(self, parent=None):
         if self.__class__ is BaseListItem:
             raise NotImplementedError
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, Paragraph, Rule, BaseList, InlineElement)
 
     def visit(self, visitor):
         return visitor.onBaseListItem(self)
 
 class ListItem(BaseListItem):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseListItem.__init__(self, parent)
 
@@ -515,6 +645,8 @@ class ListItem(BaseListItem):
         return visitor.onListItem(self)
 
 class DictionaryTerm(BaseListItem):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseListItem.__init__(self, parent)
 
@@ -522,6 +654,8 @@ class DictionaryTerm(BaseListItem):
         return visitor.onDictionaryTerm(self)
 
 class DictionaryDef(BaseListItem):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseListItem.__init__(self, parent)
 
@@ -529,34 +663,40 @@ class DictionaryDef(BaseListItem):
         return visitor.onDictionaryDef(self)
 
 class Table(BlockElement):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, TableRow)
 
     def visit(self, visitor):
         return visitor.onTable(self)
 
 class TableRow(BlockElement):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, BaseTableData)
 
     def visit(self, visitor):
         return visitor.onTableRow(self)
 
 class BaseTableData(BlockElement):
+    __slots__ = ("rowspan", "colspan")
+    allowed_contents = (CharacterData, Paragraph, InlineElement, BaseList)
+
     def __init__(self, parent=None):
         if self.__class__ is BlockElement:
             raise NotImplementedError
-        BlockElement.__init__(self, parent)
-        self.allowed_contents = (CharacterData, Paragraph, InlineElement, BaseList)
         self.rowspan = 0
         self.colspan = 0
+        BlockElement.__init__(self, parent)
 
     def visit(self, visitor):
         return visitor.onBaseTableData(self)
 
 class TableData(BaseTableData):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseTableData.__init__(self, parent)
 
@@ -564,6 +704,8 @@ class TableData(BaseTableData):
         return visitor.onTableData(self)
 
 class TableHeading(BaseTableData):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         BaseTableData.__init__(self, parent)
 
@@ -574,9 +716,11 @@ class Document(Element):
     """
     Top-level node. Should contain exactly one Division element.
     """
+    __slots__ = ()
+    allowed_contents = (CharacterData, Division)
+
     def __init__(self, parent=None):
         Element.__init__(self, parent)
-        self.allowed_contents = (CharacterData, Division)
 
     def __setitem__(self, key, child):
         if isinstance(child, Division):
@@ -585,10 +729,10 @@ class Document(Element):
 
     def append(self, child):
         if isinstance(child, Division):
-            if self.children:
+            if self._children:
                 self[0] = self._ok_to_add(child)
             else:
-                self.children.append(self._ok_to_add(child))
+                self._children = [self._ok_to_add(child)]
 
     def insert(self, i, child):
         if isinstance(child, Division):
@@ -598,6 +742,13 @@ class Document(Element):
     def visit(self, visitor):
         return visitor.onDocument(self)
 
+# Contents of these refer to classes defined after them
+Link.allowed_contents = (CharacterData, Span, Break, Image)
+BaseList.allowed_contents = (CharacterData, ListItem, InlineElement)
+DictionaryList.allowed_contents = (CharacterData, DictionaryTerm, DictionaryDef, InlineElement)
+Table.allowed_contents = (CharacterData, TableRow)
+TableRow.allowed_contents = (CharacterData, BaseTableData)
+
 class DomVisitor(object):
     """
     Abstract class for DOM visitors.  At a minimum, one must
@@ -668,9 +819,142 @@ class DomVisitor(object):
         return self.onElement(n)
 
 
+class Rendering(object):
+    """
+    Output of a visitor for an element: its opening tag, the children
+    to visit with the same visitor, and its closing tag (or None).  Iterating over it yields
+    the output for the whole subtree.  Children that render as another
+    Rendering are handled on an explicit stack rather than by nesting
+    generators, so deep documents neither recurse nor pass every
+    fragment up through one generator per level.
+    """
+    def __init__(self, visitor, open, children, close):
+        object.__init__(self)
+        self.visitor = visitor
+        self.open = open
+        self.children = children
+        self.close = close
+
+    def __iter__(self):
+        return self.main_generator()
+
+    def main_generator(self):
+        yield self.open
+        stack = [(iter(self.children), self.close)]
+
+        while stack:
+            children, close = stack[-1]
+            for child in children:
+                r = child.visit(self.visitor)
+                if isinstance(r, Rendering):
+                    yield r.open
+                    stack.append((iter(r.children), r.close))
+                    break
+                for line in r:
+                    yield line
+            else:
+                stack.pop()
+                if close is not None:
+                    yield close
+
+class Escaper(object):
+    """
+    Escapes text and quotes attribute values for HTML in one pass
+    each, with a compiled pattern and a table of replacements.  Text
+    gets the standard entities (and &, <, >) plus any in entities, a
+    dict mapping characters to entity names; if numeric is set, those
+    are written as numeric references instead.  Attribute values are
+    quoted as xml.sax.saxutils.quoteattr() does.  Use escaper() to get
+    one, since they are shared.
+
+    >>> import dom
+    >>> e = dom.escaper({ u"\u2026": u"hellip" })
+    >>> e.text(u"a < b \u2014 c\u2026")
+    u'a &lt; b &mdash; c&hellip;'
+    >>> dom.escaper(numeric=True).text(u"a & b \u2014 c")
+    u'a &amp; b &#8212; c'
+    >>> e.attr(u'say "it\\'s"'), e.attr(u"x\\ny")
+    (u'"say &quot;it\\'s&quot;"', u'"x&#10;y"')
+    """
+    def __init__(self, entities=None, numeric=False):
+        object.__init__(self)
+        names = dict(HTMLDomVisitor.chars_to_entities)
+        if entities:
+            for c, name in entities.iteritems():
+                names[c] = u"".join([u"&", name, u";"])
+        if numeric:
+            for c in names:
+                names[c] = u"&#%d;" % ord(c)
+        names.update({ u"&": u"&amp;", u"<": u"&lt;", u">": u"&gt;" })
+        self.text_table = names
+        self.text_pattern = Escaper.compile(names)
+
+        quoted = { u"&": u"&amp;", u"<": u"&lt;", u">": u"&gt;",
+            u"\n": u"&#10;", u"\r": u"&#13;", u"\t": u"&#9;" }
+        self.attr_table = quoted
+        self.attr_pattern = Escaper.compile(quoted)
+        quoted = dict(quoted)
+        quoted[u"\""] = u"&quot;"
+        self.quot_table = quoted
+        self.quot_pattern = Escaper.compile(quoted)
+
+    @staticmethod
+    def compile(table):
+        return re.compile(u"[%s]" % u"".join(re.escape(c) for c in table))
+
+    def text(self, s):
+        if not self.text_pattern.search(s):
+            return s
+        table = self.text_table
+        return self.text_pattern.sub(lambda m: table[m.group()], s)
+
+    def attr(self, s):
+        """
+        Value s escaped and in quotes, ready to follow "name=".
+        """
+        if u"\"" in s:
+            if u"'" in s:
+                table = self.quot_table
+                s = self.quot_pattern.sub(lambda m: table[m.group()], s)
+                return u"".join([u"\"", s, u"\""])
+            quote = u"'"
+        else:
+            quote = u"\""
+        if self.attr_pattern.search(s):
+            table = self.attr_table
+            s = self.attr_pattern.sub(lambda m: table[m.group()], s)
+        return u"".join([quote, s, quote])
+
+escapers = {}
+
+def escaper(entities=None, numeric=False):
+    """
+    Shared Escaper for the given extra entities and numeric setting.
+    """
+    key = (numeric, tuple(sorted((entities or {}).iteritems())))
+    try:
+        return escapers[key]
+    except KeyError:
+        escapers[key] = Escaper(entities, numeric)
+        return escapers[key]
+
 class HTMLDomVisitor(DomVisitor):
     """
     Concrete DomVisitor class for generating HTML4 from a dom tree.
+    Rendering only reads the tree, so one parsed document can be
+    rendered any number of times, by several threads at once, and
+    with different heading depths and encodings.
+
+    >>> import dom, parser, StringIO
+    >>> source = "== Title ==\\n\\n<<.b bold>> text\\n"
+    >>> doc = parser.MarkupParser().parse(StringIO.StringIO(source))
+    >>> html = "".join(doc.visit(dom.HTMLDomVisitor()))
+    >>> "".join(doc.visit(dom.HTMLDomVisitor())) == html
+    True
+    >>> "".join(doc.visit(dom.HTMLDomVisitor(1, "ascii")))
+    '\\n<div>\\n<h2>Title</h2>\\n<p>\\n<b>bold</b> text</p></div>'
+    >>> doc[0][1][0].attr.classes
+    [u'b']
     """
     magic_span_types = ( u"em", u"strong", u"b", u"i", u"tt", u"sub", u"sup", u"abbr", u"acronym", u"dfn", )
     magic_paragraph_types = ( u"blockquote", )
@@ -683,38 +967,84 @@ class HTMLDomVisitor(DomVisitor):
         chars_to_entities[unichr(_t[0])] = u"".join([u"&", _t[1], u";"])
         entities_to_chars[_t[1]] = _t[0]
 
-    def __init__(self, hd=0, enc=None):
+    def __init__(self, hd=0, enc=None, context=None):
         DomVisitor.__init__(self)
+        self.context = context or config.currentContext()
         if hd is None:
             self.heading_depth = 0
         else:
             self.heading_depth = hd
         if enc is None:
-            self.encoding = config.outputEncoding
+            self.encoding = self.context.outputEncoding
+        else:
+            self.encoding = enc
+        self.escaper = escaper(self.context.htmlEntities,
+            self.context.numericEntities)
+
+        # Pages linked to that have been looked up in the page index
+        self.index = self.context.pageIndex
+        self.known = set()
+        self.missing = set()
+
+    def look_up(self, root):
+        """
+        Find which of the local pages linked to under root are missing
+        from the page index, in one call to the index.
+        """
+        if self.index is None:
+            return
+        pages = set()
+        pending = [root]
+        while pending:
+            e = pending.pop()
+            if isinstance(e, Link):
+                if e._attr and "x-page" in e._attr:
+                    pages.add(e._attr["x-page"])
+            elif not isinstance(e, CharacterData):
+                pending.extend(e.children)
+        pages -= self.known
+        if pages:
+            self.missing.update(pages - self.index.existing(pages))
+            self.known.update(pages)
+
+    def link_attr(self, e):
+        """
+        Attributes to render link e with: those of e, or a copy marked
+        as a link to a missing page.
+        """
+        attr = e._attr
+        if self.missing and attr and attr.get("x-page") in self.missing:
+            attr = self._copy_attr(e)
+            attr.addClass(self.context.missingPageClass)
+        return attr
 
     def onNode(self, e):
         raise NotImplementedError
 
     def onText(self, e):
-        yield xmlescape(e.value, HTMLDomVisitor.chars_to_entities).encode(self.encoding)
+        yield self.escaper.text(e.value).encode(self.encoding)
 
     def onComment(self, e):
         yield (u"".join([u"<!--", e.value, u"-->"])).encode(self.encoding)
 
-    def _open_tag(self, e, name, extra_attrs=None):
-        if (not config.compactHTML) or (name in { u"p":0, u"div":0, u"h1":0, u"h2":0, u"h3":0, u"h4":0, u"h5":0, u"h6":0, u"ul":0, u"ol":0, u"dl":0, u"li":0, u"br":0, u"hr":0 }):
+    def _open_tag(self, e, name, extra_attrs=None, attr=None):
+        if (not self.context.compactHTML) or (name in { u"p":0, u"div":0, u"h1":0, u"h2":0, u"h3":0, u"h4":0, u"h5":0, u"h6":0, u"ul":0, u"ol":0, u"dl":0, u"li":0, u"br":0, u"hr":0 }):
             tag = [u"\n<", name]
         else:
             tag = [u"<", name]
 
-        for n, v in e.attr.iteritems():
-            if n.startswith("x-"):
-                continue
-            tag.extend([u" ", n, u"=", xmlquoteattr(v)])
+        quote = self.escaper.attr
+        if attr is None:
+            attr = e._attr
+        if attr:
+            for n, v in attr.iteritems():
+                if n.startswith("x-"):
+                    continue
+                tag.extend([u" ", n, u"=", quote(v)])
 
         if extra_attrs:
             for n, v in extra_attrs.iteritems():
-                tag.extend([u" ", n, u"=", xmlquoteattr(v)])
+                tag.extend([u" ", n, u"=", quote(v)])
 
         if 0 == len(e):
             tag.append(u" />")
@@ -722,35 +1052,36 @@ class HTMLDomVisitor(DomVisitor):
             tag.append(u">")
         return (u"".join(tag)).encode(self.encoding)
 
-    def _do_element(self, e, name, extra_attrs=None):
-        yield self._open_tag(e, name, extra_attrs)
+    def _close_tag(self, name):
+        return (u"".join([u"</", name, u">"])).encode(self.encoding)
 
-        for child in e:
-            for line in child.visit(self):
-                yield line
+    def _do_element(self, e, name, extra_attrs=None, attr=None):
+        if 0 == len(e):
+            close = None
+        else:
+            close = self._close_tag(name)
+        return Rendering(self, self._open_tag(e, name, extra_attrs, attr),
+            e.children, close)
 
-        if 0 != len(e):
-            yield (u"".join([u"</", name, u">"])).encode(self.encoding)
+    def _copy_attr(self, e):
+        """
+        Copy of the attributes of e, to render changed without
+        changing the tree, which may be rendered by others at once.
+        """
+        attr = AttributeMap()
+        if e._attr:
+            attr.merge(e._attr)
+        return attr
 
     def _do_special_element(self, e, name, classes):
-        found_special = False
+        attr = None
         for t in classes:
-            if e.attr.hasClass(t):
+            if e.hasClass(t):
                 name = t
-                e.attr.removeClass(t)
-                found_special = True
+                attr = self._copy_attr(e)
+                attr.removeClass(t)
                 break
-
-        yield self._open_tag(e, name)
-        if found_special:
-            e.attr.addClass(name)
-        
-        for child in e:
-            for line in child.visit(self):
-                yield line
-
-        if 0 != len(e):
-            yield (u"".join([u"</", name, u">"])).encode(self.encoding)
+        return self._do_element(e, name, None, attr)
 
     def onSpan(self, e):
         return self._do_special_element(e, u"span", HTMLDomVisitor.magic_span_types)
@@ -776,16 +1107,20 @@ class HTMLDomVisitor(DomVisitor):
         return self._do_base_table_data(e, u"th")
 
     def onHeading(self, e):
-        level = int(e.attr.get("x-level", u"2"))
+        level = 2
+        if e._attr:
+            level = int(e._attr.get("x-level", u"2"))
         return self._do_element(e, u"h%d" % (level + self.heading_depth))
 
     def onImage(self, e):
-        if not "alt" in e.attr:
-            e.attr["alt"] = u""
-        return self._do_element(e, u"img")
+        if e._attr and "alt" in e._attr:
+            return self._do_element(e, u"img")
+        attr = self._copy_attr(e)
+        attr["alt"] = u""
+        return self._do_element(e, u"img", None, attr)
 
     def onLink(self, e):
-        return self._do_element(e, u"a")
+        return self._do_element(e, u"a", None, self.link_attr(e))
     def onRule(self, e):
         return self._do_element(e, u"hr")
     def onDivision(self, e):
@@ -809,8 +1144,285 @@ class HTMLDomVisitor(DomVisitor):
     def onDictionaryDef(self, e):
         return self._do_element(e, u"dd")
     def onDocument(self, e):
-        for line in e[0].visit(self):
-            yield line
+        self.look_up(e)
+        return e[0].visit(self)
+
+    def streamDocument(self, e, blocks):
+        """
+        Render a document whose top-level blocks are still being parsed,
+        taking each block from the iterator blocks as it is finished
+        (see MarkupParser.parseBlocks()).  Output is the same as for
+        visiting the completed document.
+        """
+        opened = False
+        for b in blocks:
+            if not opened:
+                yield self._open_tag(e[0], u"div")
+                opened = True
+            self.look_up(b)
+            for line in b.visit(self):
+                yield line
+
+        if opened:
+            yield self._close_tag(u"div")
+        else:
+            for line in e.visit(self):
+                yield line
+
+class HTMLWriter(HTMLDomVisitor):
+    """
+    Faster renderer producing exactly the same HTML as HTMLDomVisitor.
+    Instead of yielding an encoded string per fragment through the
+    visitor methods, it walks the tree itself on an explicit stack,
+    looks up what to do with each node class in a table, collects the
+    unicode fragments in one list, and encodes them in large chunks.
+    Visitor methods overridden in subclasses are not used.
+
+    >>> import dom, parser, StringIO
+    >>> source = "== Title ==\\n\\nSome **bold** <<.b>> text.\\n|a|b\\n|^|c\\n"
+    >>> doc = parser.MarkupParser().parse(StringIO.StringIO(source))
+    >>> html = dom.HTMLWriter().render(doc)
+    >>> html == "".join(doc.visit(dom.HTMLDomVisitor()))
+    True
+    >>> out = StringIO.StringIO()
+    >>> dom.HTMLWriter().write(doc, out)
+    >>> out.getvalue() == html
+    True
+    """
+    TEXT, COMMENT, ELEMENT, SPECIAL, CELL, HEADING, IMAGE, DOCUMENT, LINK = \
+        range(9)
+
+    # Tags that start on a new line even in compact output
+    block_tags = frozenset([ u"p", u"div", u"h1", u"h2", u"h3", u"h4", u"h5",
+        u"h6", u"ul", u"ol", u"dl", u"li", u"br", u"hr", ])
+
+    # What to do with each class of node: (kind, tag, magic classes)
+    node_kinds = {
+        Text: (TEXT, None, None),
+        Comment: (COMMENT, None, None),
+        Document: (DOCUMENT, None, None),
+        Span: (SPECIAL, u"span", HTMLDomVisitor.magic_span_types),
+        Paragraph: (SPECIAL, u"p", HTMLDomVisitor.magic_paragraph_types),
+        TableData: (CELL, u"td", None),
+        TableHeading: (CELL, u"th", None),
+        Heading: (HEADING, None, None),
+        Image: (IMAGE, u"img", None),
+        Link: (LINK, u"a", None),
+        Rule: (ELEMENT, u"hr", None),
+        Division: (ELEMENT, u"div", None),
+        Break: (ELEMENT, u"br", None),
+        Table: (ELEMENT, u"table", None),
+        TableRow: (ELEMENT, u"tr", None),
+        OrderedList: (ELEMENT, u"ol", None),
+        UnorderedList: (ELEMENT, u"ul", None),
+        DictionaryList: (ELEMENT, u"dl", None),
+        ListItem: (ELEMENT, u"li", None),
+        DictionaryTerm: (ELEMENT, u"dt", None),
+        DictionaryDef: (ELEMENT, u"dd", None),
+    }
+
+    # Number of fragments collected before encoding and writing them
+    chunk_size = 8192
+
+    def __init__(self, hd=0, enc=None, context=None):
+        HTMLDomVisitor.__init__(self, hd, enc, context)
+        self.kinds = dict(HTMLWriter.node_kinds)
+        self.prefixes = {}
+        self.closers = {}
+
+    def kind(self, c):
+        """
+        Entry of node_kinds for class c, or for the nearest of its
+        base classes that has one (such as for arena proxies).
+        """
+        for b in c.__mro__:
+            if b in HTMLWriter.node_kinds:
+                self.kinds[c] = HTMLWriter.node_kinds[b]
+                return self.kinds[c]
+        raise NotImplementedError(c)
+
+    def prefix(self, name):
+        if (not self.context.compactHTML) or name in HTMLWriter.block_tags:
+            p = u"".join([u"\n<", name])
+        else:
+            p = u"".join([u"<", name])
+        self.prefixes[name] = p
+        self.closers[name] = u"".join([u"</", name, u">"])
+        return p
+
+    def open_tag(self, append, e, name, full, attr, skip=None, extra=None):
+        """
+        Append the opening tag of element e to the output, using
+        attribute map attr and leaving out class skip.
+        """
+        append(self.prefixes.get(name) or self.prefix(name))
+        quote = self.escaper.attr
+        if attr:
+            classes = attr.classes
+            if skip is not None:
+                classes = [c for c in classes if c != skip]
+            if classes:
+                append(u" class=")
+                append(quote(u" ".join(classes)))
+            if attr.styles:
+                append(u" style=")
+                append(quote(attr.styleval()))
+            if attr.map:
+                for n, v in attr.map.iteritems():
+                    if n.startswith("x-"):
+                        continue
+                    append(u" %s=" % n)
+                    append(quote(v))
+        if extra:
+            for n, v in extra.iteritems():
+                append(u" %s=" % n)
+                append(quote(v))
+        if full:
+            append(u">")
+        else:
+            append(u" />")
+
+    def generate(self, root, flush=None):
+        """
+        Walk the tree under root, appending fragments to a list which
+        is passed to flush (if given) whenever it gets long, and which
+        is returned at the end.
+        """
+        buf = []
+        append = buf.append
+        kinds = self.kinds
+        prefixes = self.prefixes
+        closers = self.closers
+        special = self.escaper.text_pattern.search
+        escape = self.escaper.text_pattern.sub
+        table = self.escaper.text_table
+        entity = lambda m: table[m.group()]
+        open_tag = self.open_tag
+        chunk = self.chunk_size
+        TEXT, COMMENT, ELEMENT, SPECIAL, CELL, HEADING, IMAGE, DOCUMENT, LINK = \
+            range(9)
+        self.look_up(root)
+
+        stack = [(iter((root,)), None)]
+        while stack:
+            children, close = stack[-1]
+            for e in children:
+                kind, name, magic = kinds.get(e.__class__) or self.kind(e.__class__)
+                if TEXT == kind:
+                    v = e.value
+                    if special(v):
+                        v = escape(entity, v)
+                    append(v)
+                    continue
+                elif COMMENT == kind:
+                    append(u"".join([u"<!--", e.value, u"-->"]))
+                    continue
+                elif DOCUMENT == kind:
+                    stack.append((iter((e[0],)), None))
+                    break
+
+                attr = e._attr
+                skip = None
+                extra = None
+                if SPECIAL == kind:
+                    if attr and attr.classes:
+                        for t in magic:
+                            if t in attr.classes:
+                                name = skip = t
+                                break
+                elif CELL == kind:
+                    if -1 == e.rowspan or -1 == e.colspan:
+                        continue
+                    extra = {}
+                    if e.colspan > 0:
+                        extra["colspan"] = unicode(e.colspan + 1)
+                    if e.rowspan > 0:
+                        extra["rowspan"] = unicode(e.rowspan + 1)
+                elif HEADING == kind:
+                    level = 2
+                    if attr:
+                        level = int(attr.get("x-level", u"2"))
+                    name = u"h%d" % (level + self.heading_depth)
+                elif LINK == kind:
+                    attr = self.link_attr(e)
+                elif IMAGE == kind:
+                    if not (attr and "alt" in attr):
+                        a = AttributeMap()
+                        if attr:
+                            a.merge(attr)
+                        a["alt"] = u""
+                        attr = a
+
+                children = e.children
+                if attr or extra:
+                    open_tag(append, e, name, children, attr, skip, extra)
+                else:
+                    append(prefixes.get(name) or self.prefix(name))
+                    if children:
+                        append(u">")
+                    else:
+                        append(u" />")
+                if children:
+                    stack.append((iter(children), closers[name]))
+                    break
+            else:
+                stack.pop()
+                if close is not None:
+                    append(close)
+
+            if flush and len(buf) > chunk:
+                flush(buf)
+                del buf[:]
+        return buf
+
+    def render(self, e):
+        """
+        HTML for document (or other node) e, as one encoded string.
+        """
+        return u"".join(self.generate(e)).encode(self.encoding)
+
+    def write(self, e, out, blocks=None):
+        """
+        Write the HTML for e to the file-like object out in large
+        encoded chunks.  If blocks is given, e is a document still
+        being parsed, and its top-level blocks are taken from blocks
+        as they are finished, as for streamDocument().
+        """
+        encoding = self.encoding
+        def flush(buf):
+            out.write(u"".join(buf).encode(encoding))
+
+        if blocks is None:
+            flush(self.generate(e, flush))
+            return
+
+        opened = False
+        for b in blocks:
+            if not opened:
+                out.write(self.render_start(e))
+                opened = True
+            flush(self.generate(b, flush))
+
+        if opened:
+            out.write(self.render_end(e))
+        else:
+            flush(self.generate(e, flush))
+
+    def render_start(self, e):
+        """
+        Encoded HTML that goes before the first top-level block of
+        document e, when its blocks are rendered one at a time.  Only
+        the outermost division's attributes need to be set by then.
+        """
+        buf = []
+        self.open_tag(buf.append, e[0], u"div", True, e[0]._attr)
+        return u"".join(buf).encode(self.encoding)
+
+    def render_end(self, e):
+        """
+        Encoded HTML that goes after the last top-level block of e.
+        """
+        return u"</div>".encode(self.encoding)
 
 # End of code
 
@@ -8,7 +8,7 @@ import config, utils, dom, namespaces, extensions, parser
 
 def convertFile(inf, outf, hd=0):
     print "Reading..."
-    doc = parser.MarkupParser().parse(iter(open(inf)))
+    doc = parser.MarkupParser().parse(iter(open(inf)), flat=True)
     print "\nWriting..."
     open(outf, "w").writelines(doc.visit(dom.KindleDomVisitor(hd)))
 
@@ -5,8 +5,9 @@ extensions.py: A module from EWC (http://piclab.com/ewc/).
 Handling extensions to WikiCreole.
 """
 
-import sys, re
+import os, sys, re, threading
 from os.path import join as pathjoin
+from collections import OrderedDict
 
 # relative imports
 import config
@@ -63,13 +64,19 @@ class ExtensionTransform(object):
     """
     Create a wrapper around a source iterator that extracts
     and processes extension markup.  I love generators :-)
+    in_block is true while an extension is reading the lines of its
+    block from the source.
     """
     raw_pattern = re.compile(u"(.*?)\\{\\{\\{(.*)$")
     ext_pattern = re.compile(u"(.*?)<<(!|[A-Za-z_][A-Za-z0-9_-]*)(.*)$")
 
-    def __init__(self, source):
+    def __init__(self, source, pc=None):
         object.__init__(self)
         self.stack = [source]
+        self.pc = pc or config.currentContext()
+        self.invocations = {}
+        self.depth = 0
+        self.in_block = False
 
     def __iter__(self):
         return self.main_generator()
@@ -127,73 +134,126 @@ class ExtensionTransform(object):
 
             content = content.lstrip()
             end = content.find(end_pattern)
-            ext = config.parsingContext.getExtension(name)
+            ext = self.pc.getExtension(name)
+            self.invocations[name] = self.invocations.get(name, 0) + 1
 
             if -1 == end:
-                result, tail = ext.block(content, source, end_pattern)
+                self.in_block = True
+                try:
+                    result, tail = ext.block(content, source, end_pattern)
+                finally:
+                    self.in_block = False
             else:
                 tail = content[end+len(end_pattern):]
                 result = ext.inline(content[:end])
 
-            if len(self.stack) > config.includeDepthLimit:
+            if len(self.stack) > self.pc.includeDepthLimit:
                 raise MemoryError("Exceeded input stack depth limit (probably recursion problem)")
             self.stack.append(self.look_ahead(result, head, tail))
+            self.depth = max(self.depth, len(self.stack) - 1)
+
+def blockEnd(line):
+    """
+    If line (escaped, as ExtensionTransform sees it) opens an
+    extension block that it doesn't close, return the pattern that
+    will end the block, otherwise None.  Extensions closed on the line
+    are skipped as the transform would, since what follows them can
+    open a block of its own.
+
+    >>> import extensions
+    >>> extensions.blockEnd(u"a <<include x>> b"), extensions.blockEnd(u"<<!")
+    (None, u'>>')
+    >>> extensions.blockEnd(u"<<x a>> {{{"), extensions.blockEnd(u"{{{a}}}")
+    (u'}}}', None)
+    """
+    while True:
+        m = ExtensionTransform.raw_pattern.match(line)
+        if m:
+            content = m.group(2)
+            end_pattern = u"}}}"
+        else:
+            m = ExtensionTransform.ext_pattern.match(line)
+            if not m:
+                return None
+            content = m.group(3)
+            end_pattern = u">>"
+
+        content = content.lstrip()
+        end = content.find(end_pattern)
+        if -1 == end:
+            return end_pattern
+        line = content[end+len(end_pattern):]
+
 #
 # A few functions handy for use in extensions here.
 #
+# Rest of a name after its first letter: letters, digits, "-_."
+name_pattern = re.compile(u"[\\w.-]*", re.UNICODE)
+
+# Body of a quoted value (to the closing quote, if any), and the
+# backslash escapes in it
+quoted_patterns = {
+    u"\"": re.compile(u"((?:[^\"\\\\]|\\\\.)*)\\\\?(\")?", re.DOTALL),
+    u"'": re.compile(u"((?:[^'\\\\]|\\\\.)*)\\\\?(')?", re.DOTALL),
+}
+backslash_pattern = re.compile(u"\\\\(.)", re.DOTALL)
+backslash_escapes = { u"t": u"\t", u"n": u"\n" }
+
+def _unbackslash(m):
+    c = m.group(1)
+    return backslash_escapes.get(c, c)
+
 def token(ins):
     """
     Tokenizer for parsing simple name=value pairs.
+
+    >>> import extensions
+    >>> extensions.token(u" name-1.x = 2")
+    (u'name-1.x', u'= 2')
+    >>> extensions.token(u"'a \\\\'b\\\\' \\\\tc' rest")
+    (u"a 'b' \\tc", u'rest')
+    >>> extensions.token(u'"unterminated\\\\')
+    (u'unterminated', u'')
     """
     # TODO: \xFF, \u00FF, etc.
-    varname_chars = [unichr(c) for c in xrange(sys.maxunicode) if unichr(c).isalnum()]
-    varname_chars.extend(u"-_.")
-
     ins = ins.lstrip()
     if not ins:
         return u"", u""
 
     f = ins[0]
     if f.isalpha():
-        result = [f]
-        i = 1
-        while i < len(ins) and ins[i] in varname_chars:
-            result.append(ins[i])
-            i += 1
-        return u"".join(result), ins[i:].lstrip()
+        i = name_pattern.match(ins, 1).end()
+        return ins[:i], ins[i:].lstrip()
     elif (u"'" == f or u"\"" == f):
-        result = []
-        slashmode = False
-        i = 1
-        while True:
-            if i >= len(ins):
-                return u"".join(result), u""
-
-            if slashmode:
-                if u"t" == ins[i]:
-                    result.append(u"\t")
-                elif u"n" == ins[i]:
-                    result.append(u"\n")
-                else:
-                    result.append(ins[i])
-                slashmode = False
-            else:
-                if u"\\" == ins[i]:
-                    slashmode = True
-                elif f == ins[i]:
-                    return u"".join(result), ins[i+1:].lstrip()
-                else:
-                    result.append(ins[i])
-            i += 1
+        m = quoted_patterns[f].match(ins, 1)
+        value = m.group(1)
+        if u"\\" in value:
+            value = backslash_pattern.sub(_unbackslash, value)
+        if m.group(2) is None:
+            return value, u""
+        return value, ins[m.end():].lstrip()
     else:
         return f, ins[1:]
 
+# Parsed argument strings, up to assignmentsLimit of them
+assignmentsLimit = 1000
+assignments = {}
+
 def variableAssignments(line):
     """
     Parse name=value pairs on an input line, returning a list
     of tuples (or None if a blank line).
+
+    >>> import extensions
+    >>> extensions.variableAssignments(u"file.ewc a=1 b c='x y'")
+    [(u'file.ewc', u''), (u'a', u'1'), (u'b', u''), (u'c', u'x y')]
     """
     assert isinstance(line, unicode)
+    try:
+        return list(assignments[line])
+    except KeyError:
+        pass
+    key = line
     v = []
 
     name = None
@@ -211,6 +271,9 @@ def variableAssignments(line):
         else:
             v.append((name, u""))
             name = t
+
+    if len(assignments) < assignmentsLimit:
+        assignments[key] = tuple(v)
     return v
 
 def variableSubstitutions(source, vars):
@@ -269,10 +332,127 @@ class EscapeText(Extension):
             for line in block:
                 yield self._escape(line)
 
+class IncludeCache(object):
+    """
+    Included files, each read from disk and run through
+    EscapeTransform once and kept as a tuple of lines, to be shared by
+    every <<include>> of it.  An entry is used only while the file's
+    modification time and size are unchanged.  The least recently used
+    entries are dropped beyond maxEntries files or maxChars characters.
+
+    >>> import extensions, tempfile, os
+    >>> d = tempfile.mkdtemp()
+    >>> name = os.path.join(d, "x.ewc")
+    >>> open(name, "w").write("one ~* \\\\\\ntwo\\n")
+    >>> ic = extensions.IncludeCache()
+    >>> ic.lines(name, "ascii")
+    (u'one \\uef2a two',)
+    >>> ic.lines(name, "ascii") is ic.lines(name, "ascii")
+    True
+    >>> sorted(ic.stats().items()), ic.hitRate()
+    ([('evictions', 0), ('hits', 2), ('misses', 1), ('reloads', 0)], 0.6666666666666666)
+    """
+    def __init__(self, maxEntries=256, maxChars=16*1024*1024):
+        object.__init__(self)
+        self.maxEntries = maxEntries
+        self.maxChars = maxChars
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "evictions": self.evictions,
+        }
+
+    def hitRate(self):
+        """
+        Fraction of lookups served from the cache.
+        """
+        total = self.hits + self.misses + self.reloads
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def lines(self, name, encoding):
+        """
+        Escaped lines of file name, decoded from encoding.  Raises
+        IOError if it can't be read.
+        """
+        f = open(name)
+        try:
+            st = os.fstat(f.fileno())
+            stamp = (st.st_mtime, st.st_size)
+            key = (name, encoding)
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    if stamp == entry[0]:
+                        self.entries[key] = entry
+                        self.hits += 1
+                        return entry[1]
+                    self.chars -= entry[2]
+                    self.reloads += 1
+                else:
+                    self.misses += 1
+
+            lines = tuple(EscapeTransform(line.decode(encoding, "ignore")
+                for line in f))
+        finally:
+            f.close()
+
+        size = sum(len(line) for line in lines)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.chars -= old[2]
+            self.entries[key] = (stamp, lines, size)
+            self.chars += size
+            while len(self.entries) > 1 and (len(self.entries) >
+                self.maxEntries or self.chars > self.maxChars):
+                k, (s, l, n) = self.entries.popitem(last=False)
+                self.chars -= n
+                self.evictions += 1
+        return lines
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+
+includeCache = IncludeCache()
+
 class IncludeFile(Extension):
-    def __init__(self):
+    """
+    Insert the contents of a file from config.includePath, replacing
+    $$name$$ references in it with the values assigned in the block.
+    Files are read through the shared includeCache, and their paths
+    added to the context's includes, whether they exist or not.
+
+    >>> import extensions, config, tempfile, os
+    >>> d = tempfile.mkdtemp()
+    >>> open(os.path.join(d, "hi.ewc"), "w").write("Hello, $$who$$!\\n")
+    >>> c = config.parsingContext.copy()
+    >>> c.includePath = d
+    >>> previous = config.activate(c)
+    >>> inc = extensions.IncludeFile()
+    >>> list(inc.transform(u"hi.ewc", [u"who=world"]))
+    [u'Hello, world!']
+    >>> list(inc.transform(u"hi.ewc", None))
+    [u'Hello, \\uef24\\uef24who\\uef24\\uef24!']
+    >>> c = config.activate(previous)
+    """
+    def __init__(self, cache=None):
         Extension.__init__(self)
-        self.vars = {}
+        self.cache = cache or includeCache
 
     def error(self, msg):
         yield u"(ERROR: IncludeFile: %s)" % msg
@@ -281,20 +461,23 @@ class IncludeFile(Extension):
         v = variableAssignments(contents)
         if not v:
             return self.error(u"No filename.")
-        else:
-            name = pathjoin([config.includePath, v[0][0]])
+        pc = config.currentContext()
+        name = pathjoin(pc.includePath, v[0][0])
+        if pc.includes is not None and not name in pc.includes:
+            pc.includes.append(name)
         try:
-            source = open(name)
+            lines = self.cache.lines(name, pc.inputEncoding)
         except IOError:
             return self.error(u"Can't open \"%s\"." % name)
 
+        vars = {}
         if block:
             for line in block:
                 v = variableAssignments(line)
                 if v:
-                    self.vars.update(dict(v))
+                    vars.update(dict(v))
 
-        return variableSubstitutions(EscapeTransform(source), self.vars)
+        return variableSubstitutions(iter(lines), vars)
 
 class Rot13(Extension):
     """
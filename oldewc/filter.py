@@ -15,6 +15,11 @@ import ewc.config
 # ewc.config.localLinkPattern = "/w/%s.html"
 # ewc.config.localImagePattern = "/images/%s"
 # ewc.config.includePath = "/includes"
+#
+# Rendered pages are cached in memory; to keep them on disk too:
+#
+# import ewc.cache
+# ewc.cache.defaultCache = ewc.cache.RenderCache(directory="/var/cache/ewc")
 
 register = template.Library()
 
@@ -25,7 +30,7 @@ register = template.Library()
 @stringfilter
 def creole(ins, arg=None):
     try:
-        import ewc.parser
+        import ewc.cache
     except ImportError:
         if settings.DEBUG:
             raise template.TemplateSyntaxError, "Error in {% creole %} filter: EWC library not found."
@@ -37,4 +42,4 @@ def creole(ins, arg=None):
                 depth = int(arg)
             except:
                 pass
-        return mark_safe(ewc.parser.convertString(ins, depth))
+        return mark_safe(ewc.cache.convertString(ins, depth))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+incremental.py: A module from EWC (http://piclab.com/ewc/).
+
+Incremental re-rendering of a document that is being edited, for
+things like live editor previews.  Each revision is split into
+chunks at blank lines, and only chunks that differ from the previous
+revision (or that follow different open divisions) are parsed and
+rendered again; the HTML of the rest is reused.
+"""
+
+import StringIO, hashlib
+
+# relative imports
+import config, utils, dom, extensions, parser
+
+OPEN, CLOSE, BLOCK = range(3)
+
+class IncrementalParser(object):
+    """
+    Convert successive revisions of a document to HTML, producing the
+    same output as convertString() but reparsing only what changed.
+
+    The line transforms (escapes, extensions and includes) are run over
+    the whole revision, and the resulting lines are cut into chunks
+    after each blank line.  At a blank line the block parser has closed
+    everything but divisions and forgotten any pending styles, so a
+    chunk's HTML depends only on its lines and the divisions open
+    before it.  Both go into the cache key.
+
+    Each revision is converted with the context given, or else with a
+    fresh copy of the global config.parsingContext.  Cached chunks are
+    dropped whenever its settingsKey() changes, as it does when pages
+    are added to or removed from its pageIndex, and aren't kept at all
+    if the index can't tell (see config.ParsingContext.settingsKey()).
+
+    >>> import incremental, parser
+    >>> ip = incremental.IncrementalParser()
+    >>> source = "== Title ==\\n\\nFirst.\\n\\n<<.box\\nSecond.\\n\\n>>\\n"
+    >>> ip.convert(source) == parser.convertString(source)
+    True
+    >>> ip.parsed, ip.reused
+    (4, 0)
+    >>> source = source.replace("First", "**First**")
+    >>> ip.convert(source) == parser.convertString(source)
+    True
+    >>> ip.parsed, ip.reused
+    (1, 3)
+    >>> source = "{{a.png|x~*y}} \xc3\xa9"
+    >>> ip.convert(source) == parser.convertString(source)
+    True
+
+    Links to pages missing from the page index are marked:
+
+    >>> import config, pageindex
+    >>> c = config.parsingContext.copy()
+    >>> c.pageIndex = pageindex.SetIndex()
+    >>> ip = incremental.IncrementalParser(context=c)
+    >>> print ip.convert("[[Page]]\\n\\nText.\\n").split("\\n")[3]
+    <a class="missing" href="/w/page.html">Page</a></p>
+    >>> c.pageIndex.add([u"Page"])
+    >>> print ip.convert("[[Page]]\\n\\nText.\\n").split("\\n")[3]
+    <a href="/w/page.html">Page</a></p>
+    >>> ip.parsed, ip.reused
+    (2, 0)
+    """
+    def __init__(self, hd=0, context=None):
+        object.__init__(self)
+        self.heading_depth = hd
+        self.context = context
+        self.cache = {}
+        self.settings = None
+        self.parsed = 0
+        self.reused = 0
+
+    def current_settings(self, context):
+        key = context.settingsKey()
+        if key is None:
+            return None
+        return (self.heading_depth, key)
+
+    def split_chunks(self, lines):
+        """
+        Cut transformed lines into chunks, each ending with the blank
+        lines that follow it.
+        """
+        chunks = []
+        chunk = []
+        for line in lines:
+            if line and chunk and not chunk[-1]:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(line)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def open_head(self, visitor, d):
+        """
+        The opening tag of division d without its final ">" or " />",
+        which can't be chosen until we know whether d has contents.
+        """
+        tag = visitor._open_tag(d, u"div").decode(visitor.encoding)
+        if tag.endswith(u" />"):
+            return tag[:-3]
+        return tag[:-1]
+
+    def parse_chunk(self, context, visitor, state, lines):
+        """
+        Parse one chunk inside the divisions described by state,
+        returning its rendering as a list of events (divisions opened
+        and closed, and finished blocks) and the state after it.
+        """
+        p = parser.MarkupParser(context=context)
+        root = p.stack[0]
+        initial = [root]
+        for items in state:
+            d = dom.Division(initial[-1])
+            for k, v in items:
+                d.attr[k] = v
+            initial.append(d)
+        p.stack.extend(initial[1:])
+
+        p.doBlockMarkup(iter(lines))
+        final = [d for d in p.stack if isinstance(d, dom.Division)]
+
+        events = []
+        pending = [root]
+        while pending:
+            c = pending.pop()
+            if c is None:
+                events.append((CLOSE,))
+            elif c is root or c in initial:
+                if c is not root and not c in final:
+                    pending.append(None)
+                pending.extend(reversed(c.children))
+            elif c in final:
+                events.append((OPEN, self.open_head(visitor, c)))
+                pending.extend(reversed(c.children))
+            else:
+                p.doInlineMarkup(c)
+                p.doMagicComments(c)
+                p.removeEscapes(c)
+                c.normalize()
+                visitor.look_up(c)
+                html = "".join(c.visit(visitor))
+                events.append((BLOCK, html.decode(visitor.encoding)))
+
+        state = tuple(tuple(d.attr.items()) for d in final[1:])
+        return events, state
+
+    def splice(self, visitor, events):
+        out = []
+        head = None
+        for e in events:
+            if head is not None:
+                if CLOSE == e[0]:
+                    out.append(head + u" />")
+                    head = None
+                    continue
+                out.append(head + u">")
+                head = None
+
+            if OPEN == e[0]:
+                head = e[1]
+            elif CLOSE == e[0]:
+                out.append(visitor._close_tag(u"div").decode(
+                    visitor.encoding))
+            else:
+                out.append(e[1])
+        return u"".join(out)
+
+    def convert(self, ins):
+        """
+        Convert a new revision of the document, returning its HTML.
+        Afterwards, parsed and reused hold the number of chunks that
+        were parsed and taken from the cache.
+        """
+        context = self.context or config.parsingContext.copy()
+        settings = self.current_settings(context)
+        if settings is None or settings != self.settings:
+            self.cache = {}
+            self.settings = settings
+
+        pass1 = utils.UnicodeTransform(StringIO.StringIO(ins))
+        pass2 = utils.EscapeTransform(iter(pass1))
+        pass3 = extensions.ExtensionTransform(iter(pass2), context)
+        previous = config.activate(context)
+        try:
+            chunks = self.split_chunks(pass3)
+        finally:
+            config.activate(previous)
+
+        visitor = dom.HTMLDomVisitor(self.heading_depth, context=context)
+        events = [(OPEN, self.open_head(visitor, dom.Division()))]
+        cache = {}
+        state = ()
+        self.parsed = 0
+        self.reused = 0
+
+        for lines in chunks:
+            h = hashlib.sha1()
+            for line in lines:
+                h.update(line.encode("utf-8"))
+                h.update("\n")
+            key = (state, h.digest())
+
+            if key in self.cache:
+                result = self.cache[key]
+                self.reused += 1
+            else:
+                result = self.parse_chunk(context, visitor, state, lines)
+                self.parsed += 1
+            cache[key] = result
+            events.extend(result[0])
+            state = result[1]
+
+        for d in state:
+            events.append((CLOSE,))
+        events.append((CLOSE,))
+
+        self.cache = cache
+        return self.splice(visitor, events)
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
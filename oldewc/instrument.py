@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+instrument.py: A module from EWC (http://piclab.com/ewc/).
+
+Collecting timings and counts from the parser.  Set
+config.parsingContext.sink to one of the sinks here (or any object
+with the same three methods) and MarkupParser.parse() and
+convertString() will report to it: the wall time of each phase, and
+counts of lines, blocks, nodes by class, extension invocations by
+name, the include depth reached, and bytes of HTML emitted.  With
+no sink attached the parser runs exactly as before.
+
+Phase names are those in the phases tuple below.  Counter names are
+"documents", "lines", "blocks", "nodes" (labelled by class name),
+"extensions" (labelled by extension name) and "bytes"; the only
+maximum is "includeDepth".
+"""
+
+import threading
+
+phases = ("unicode", "escape", "extension", "block", "inline", "magic",
+    "unescape", "normalize", "render")
+
+class Sink(object):
+    """
+    Abstract base class for instrumentation sinks.
+    """
+    def __init__(self):
+        if self.__class__ is Sink:
+            raise NotImplementedError
+        object.__init__(self)
+
+    def phase(self, name, seconds):
+        raise NotImplementedError
+
+    def count(self, name, n=1, label=None):
+        raise NotImplementedError
+
+    def maximum(self, name, value):
+        raise NotImplementedError
+
+class CallbackSink(Sink):
+    """
+    Pass each event on to a function as (kind, name, value, label),
+    where kind is "phase", "count" or "maximum".
+
+    >>> import instrument
+    >>> events = []
+    >>> s = instrument.CallbackSink(lambda *e: events.append(e))
+    >>> s.phase("block", 0.5)
+    >>> s.count("nodes", 3, "Paragraph")
+    >>> events
+    [('phase', 'block', 0.5, None), ('count', 'nodes', 3, 'Paragraph')]
+    """
+    def __init__(self, callback):
+        Sink.__init__(self)
+        self.callback = callback
+
+    def phase(self, name, seconds):
+        self.callback("phase", name, seconds, None)
+
+    def count(self, name, n=1, label=None):
+        self.callback("count", name, n, label)
+
+    def maximum(self, name, value):
+        self.callback("maximum", name, value, None)
+
+class DictSink(Sink):
+    """
+    Accumulate totals over any number of documents, to be read with
+    snapshot().  Safe to share between threads.
+
+    >>> import instrument
+    >>> s = instrument.DictSink()
+    >>> s.phase("block", 0.25); s.phase("block", 0.5)
+    >>> s.count("lines", 10); s.count("nodes", 2, "Text")
+    >>> s.maximum("includeDepth", 2); s.maximum("includeDepth", 1)
+    >>> snap = s.snapshot()
+    >>> snap["phases"], snap["lines"], snap["nodes"], snap["includeDepth"]
+    ({'block': 0.75}, 10, {'Text': 2}, 2)
+    """
+    def __init__(self):
+        Sink.__init__(self)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self.maxima = {}
+
+    def phase(self, name, seconds):
+        self.lock.acquire()
+        try:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        finally:
+            self.lock.release()
+
+    def count(self, name, n=1, label=None):
+        self.lock.acquire()
+        try:
+            c = self.counters.setdefault(name, {})
+            c[label] = c.get(label, 0) + n
+        finally:
+            self.lock.release()
+
+    def maximum(self, name, value):
+        self.lock.acquire()
+        try:
+            if value > self.maxima.get(name, value - 1):
+                self.maxima[name] = value
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Copy of the totals as a plain dict: "phases" maps phase names
+        to seconds, and each counter or maximum appears under its own
+        name, as a number or (for labelled counters) a dict.
+        """
+        self.lock.acquire()
+        try:
+            snap = { "phases": dict(self.phases) }
+            for name, c in self.counters.iteritems():
+                if c.keys() == [None]:
+                    snap[name] = c[None]
+                else:
+                    snap[name] = dict(c)
+            snap.update(self.maxima)
+            return snap
+        finally:
+            self.lock.release()
+
+class PrometheusSink(DictSink):
+    """
+    Accumulate totals like DictSink, and render them in the
+    Prometheus text exposition format.
+
+    >>> import instrument
+    >>> s = instrument.PrometheusSink()
+    >>> s.phase("block", 0.5); s.count("nodes", 2, "Text")
+    >>> print s.exposition(),
+    # HELP ewc_phase_seconds_total Wall time spent in each parser phase.
+    # TYPE ewc_phase_seconds_total counter
+    ewc_phase_seconds_total{phase="block"} 0.5
+    # HELP ewc_nodes_total Document nodes created, by class.
+    # TYPE ewc_nodes_total counter
+    ewc_nodes_total{class="Text"} 2
+    """
+    metrics = (
+        ("documents", "counter", None, "Documents parsed."),
+        ("lines", "counter", None, "Source lines read."),
+        ("blocks", "counter", None, "Top-level blocks parsed."),
+        ("nodes", "counter", "class", "Document nodes created, by class."),
+        ("extensions", "counter", "extension", "Extension invocations, by name."),
+        ("bytes", "counter", None, "Bytes of HTML emitted."),
+        ("includeDepth", "gauge", None, "Deepest nesting of extension and include expansion."),
+    )
+    names = {
+        "includeDepth": "include_depth_max",
+        "bytes": "output_bytes",
+    }
+
+    def __init__(self, prefix="ewc"):
+        DictSink.__init__(self)
+        self.prefix = prefix
+
+    def exposition(self):
+        snap = self.snapshot()
+        out = []
+        def header(metric, kind, help):
+            out.append("# HELP %s %s\n" % (metric, help))
+            out.append("# TYPE %s %s\n" % (metric, kind))
+
+        if snap["phases"]:
+            metric = "%s_phase_seconds_total" % self.prefix
+            header(metric, "counter", "Wall time spent in each parser phase.")
+            for name in sorted(snap["phases"]):
+                out.append("%s{phase=\"%s\"} %r\n" % (metric, name,
+                    snap["phases"][name]))
+
+        for name, kind, label, help in PrometheusSink.metrics:
+            if not name in snap:
+                continue
+            metric = "%s_%s" % (self.prefix, PrometheusSink.names.get(name, name))
+            if "counter" == kind:
+                metric += "_total"
+            header(metric, kind, help)
+            value = snap[name]
+            if isinstance(value, dict):
+                for k in sorted(value):
+                    out.append("%s{%s=\"%s\"} %r\n" % (metric, label,
+                        escapeLabel(k), value[k]))
+            else:
+                out.append("%s %r\n" % (metric, value))
+        return "".join(out)
+
+def escapeLabel(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(u"\"",
+        u"\\\"").replace(u"\n", u"\\n").encode("utf-8")
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
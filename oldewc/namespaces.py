@@ -7,12 +7,15 @@ Most users will just want to change the paths in the Local namespace
 by assigning them in config.py.
 """
 
-import md5
+import re, hashlib
 
 # relative imports
 import config
 from utils import makeUnicode, removeEscapes
 
+# Rest of a namespace prefix after its first letter, and the colon
+prefix_pattern = re.compile(u"[\\w-]*:", re.UNICODE)
+
 def getPrefix(line):
     """
     If line begins with a colon-separated namespace prefix, return it
@@ -47,24 +50,17 @@ def getPrefix(line):
     if not line[0].isalpha():
         return u"", line
 
-    ns = [line[0]]
-    i = 1
-    while True:
-        if i >= len(line):
-            return u"", line
-        if u":" == line[i]:
-            return u"".join(ns), line[i+1:]
-        elif (line[i].isalnum()) or (line[i] in u"-_"):
-            ns.append(line[i])
-        else:
-            return u"", line
-        i += 1
+    m = prefix_pattern.match(line, 1)
+    if not m:
+        return u"", line
+    return line[:m.end()-1], line[m.end():]
 
 def linkURL(name, pc=None):
     """
     Given link text with a possible colon-separated namespace prefix,
     return a complete URL for a link.
     """
+    pc = pc or config.currentContext()
     name = removeEscapes(name).lstrip().rstrip()
     if u"/" == name[0] or u"#" == name[0]:
         return name
@@ -74,14 +70,36 @@ def linkURL(name, pc=None):
         if ns in config.standardURISchemes:
             return name
         else:
-            return config.parsingContext.getNamespace(ns).linkURL(tail)
-    return config.parsingContext.getNamespace(u"").linkURL(tail)
+            return pc.getNamespace(ns).linkURL(tail)
+    return pc.getNamespace(u"").linkURL(tail)
+
+def pageName(name, pc=None):
+    """
+    Normalized name of the local page that link text name points to,
+    or None if it is a link to anything else.
+
+    >>> import namespaces
+    >>> namespaces.pageName(u" Some Page"), namespaces.pageName(u"wp:Page")
+    (u'some_page', None)
+    """
+    pc = pc or config.currentContext()
+    name = removeEscapes(name).lstrip().rstrip()
+    if not name or u"/" == name[0] or u"#" == name[0]:
+        return None
+
+    ns, tail = getPrefix(name)
+    if ns in config.standardURISchemes:
+        return None
+    if not isinstance(pc.getNamespace(ns), Local):
+        return None
+    return Local.normalize(tail)
 
 def imageURL(name, pc=None):
     """
     Given link text with a possible colon-separated namespace prefix,
     return a complete URL for an image.
     """
+    pc = pc or config.currentContext()
     name = removeEscapes(name).lstrip().rstrip()
     if u"/" == name[0]:
         return name
@@ -91,22 +109,58 @@ def imageURL(name, pc=None):
         if ns in config.standardURISchemes:
             iu = name
         else:
-            iu = config.parsingContext.getNamespace(ns).imageURL(tail)
-    iu = config.parsingContext.getNamespace(u"").imageURL(tail)
+            iu = pc.getNamespace(ns).imageURL(tail)
+    iu = pc.getNamespace(u"").imageURL(tail)
 
     if iu is None:
         return u""      # Link to local error image?
     else:
         return iu
 
+# Characters replaced by mangle functions, and translate tables for them
+urlSpecials = u"%&?<>()[]{}*+\\/`~;:@="
+localSpecials = u"\t\n:\"'%&?<>[]{}*+\\/`~;:@=|$"
+
+def escapeTable(chars, escape, space=None):
+    """
+    Table for unicode.translate() replacing each character in chars by
+    escape and its code in two hex digits, and spaces by space.
+    """
+    table = dict((ord(c), u"%s%02x" % (escape, ord(c))) for c in chars)
+    if space is not None:
+        table[ord(u" ")] = space
+    return table
+
+def mangleAll(mangle, titles):
+    """
+    List of the results of mangle for each of titles, each distinct
+    title being mangled once; for building indexes of many pages.
+    """
+    done = {}
+    for t in titles:
+        if not t in done:
+            done[t] = mangle(t)
+    return [done[t] for t in titles]
+
+# Most URLs cached by each handler; a full cache is emptied
+cacheLimit = 10000
+
+def remember(cache, key, value):
+    if len(cache) >= cacheLimit:
+        cache.clear()
+    cache[key] = value
+    return value
+
 class Namespace(object):
     """
-    Abstract base class for external namespace handlers.
+    Abstract base class for external namespace handlers.  Handlers
+    that compute URLs from names alone keep them in self.urls.
     """
     def __init__(self):
         if self.__class__ is Namespace:
             raise NotImplementedError
         object.__init__(self)
+        self.urls = {}
 
     def linkURL(self, name):
         raise NotImplementedError
@@ -125,6 +179,8 @@ class Local(Namespace):
     >>> ns.imageURL("imagename.png")
     u'/images/imagename.png'
     """
+    table = escapeTable(localSpecials, u"$")
+
     def __init__(self):
         Namespace.__init__(self)
 
@@ -155,16 +211,16 @@ class Local(Namespace):
         >>> namespaces.Local.mangle("2: A 10% $5 B_C")
         u'2$3a_a_10$25_$245_b_c'
         """
-        title = Local.normalize(title)
-        result = []
+        return Local.normalize(title).translate(Local.table)
 
-        for c in title:
-            if c in u"\t\n:\"'%&?<>[]{}*+\\/`~;:@=|$":
-                result.append(u"$")
-                result.append((u"0"+hex(ord(c))[2:])[-2:])
-            else:
-                result.append(c)
-        return u"".join(result)
+    @staticmethod
+    def mangleAll(titles):
+        """
+        >>> import namespaces
+        >>> namespaces.Local.mangleAll([u"A b", u"C?", u"A b"])
+        [u'a_b', u'c$3f', u'a_b']
+        """
+        return mangleAll(Local.mangle, titles)
 
     @staticmethod
     def demangle(name):
@@ -190,11 +246,18 @@ class Local(Namespace):
         s = removeEscapes(s)
         return s.capitalize()
 
+    def url(self, pattern, title):
+        try:
+            return self.urls[pattern, title]
+        except KeyError:
+            return remember(self.urls, (pattern, title),
+                makeUnicode(pattern) % Local.mangle(title))
+
     def linkURL(self, title):
-        return makeUnicode(config.localLinkPattern) % Local.mangle(title)
+        return self.url(config.currentContext().localLinkPattern, title)
 
     def imageURL(self, title):
-        return makeUnicode(config.localImagePattern) % Local.mangle(title)
+        return self.url(config.currentContext().localImagePattern, title)
 
 class Wikipedia(Namespace):
     """
@@ -207,59 +270,68 @@ class Wikipedia(Namespace):
     >>> ns.imageURL("imagename.png")
     u'http://upload.wikimedia.org/wikipedia/en/8/89/Imagename.png'
     """
+    table = escapeTable(urlSpecials, u"%", u"_")
+
     def __init__(self):
         Namespace.__init__(self)
 
     @staticmethod
     def mangle(title):
-        r = [title[0].upper()]
-        for c in title[1:]:
-            if u" " == c:
-                r.append(u"_")
-            elif c in u"%&?<>()[]{}*+\\/`~;:@=":
-                r.append(u"%")
-                r.append((u"0"+hex(ord(c))[2:])[-2:])
-            else:
-                r.append(c)
-        return u"".join(r)
+        title = makeUnicode(title)
+        return title[:1].upper() + title[1:].translate(Wikipedia.table)
+
+    @staticmethod
+    def mangleAll(titles):
+        return mangleAll(Wikipedia.mangle, titles)
 
     def linkURL(self, name):
+        try:
+            return self.urls[u"link", name]
+        except KeyError:
+            pass
         ns, tail = getPrefix(name)
         if not ns:
             ns = u"en"
         path = u"http://%s.wikipedia.org/wiki/" % ns
-        return u"".join([path, Wikipedia.mangle(tail)])
+        return remember(self.urls, (u"link", name),
+            u"".join([path, Wikipedia.mangle(tail)]))
 
     def imageURL(self, name):
+        try:
+            return self.urls[u"image", name]
+        except KeyError:
+            pass
         ns, tail = getPrefix(name)
         if not ns:
             ns = u"en"
         path = u"http://upload.wikimedia.org/wikipedia/%s/" % ns
-        name = Wikipedia.mangle(tail)
+        title = Wikipedia.mangle(tail)
 
-        h = md5.new(Wikipedia.mangle(name).encode())
+        h = hashlib.md5(Wikipedia.mangle(title).encode())
         d = h.hexdigest()
-        return u"".join([path, d[0:1], u"/", d[0:2], u"/", name])
+        return remember(self.urls, (u"image", name),
+            u"".join([path, d[0:1], u"/", d[0:2], u"/", title]))
 
 class Google(Namespace):
+    table = escapeTable(urlSpecials, u"%", u"+")
+
     def __init__(self):
         Namespace.__init__(self)
 
     @staticmethod
     def mangle(name):
-        r = []
-        for c in name:
-            if u" " == c:
-                r.append(u"+")
-            elif c in u"%&?<>()[]{}*+\\/`~;:@=":
-                r.append(u"%")
-                r.append((u"0"+hex(ord(c))[2:])[-2:])
-            else:
-                r.append(c)
-        return u"".join(r)
+        return makeUnicode(name).translate(Google.table)
+
+    @staticmethod
+    def mangleAll(names):
+        return mangleAll(Google.mangle, names)
 
     def linkURL(self, name):
-        return u"http://www.google.com/search?hl=en&q=%s" % Google.mangle(name)
+        try:
+            return self.urls[name]
+        except KeyError:
+            return remember(self.urls, name,
+                u"http://www.google.com/search?hl=en&q=%s" % Google.mangle(name))
 
     def imageURL(self, name):
         return None
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+pageindex.py: A module from EWC (http://piclab.com/ewc/).
+
+Indexes of existing pages, so that links to pages that don't exist
+yet can be marked when rendering.  Set the pageIndex of a parsing
+context to one of the indexes here (or any object with an existing()
+method) and the HTML renderers will add the class named by
+config.missingPageClass to every local link whose page is not in it.
+The pages linked from a document are looked up in a single call to
+existing() before it is rendered (or one per block, when streaming).
+
+Pages are identified by their names as normalized by
+namespaces.Local.normalize(); the add() methods normalize titles given
+to them, and existing() expects names already normalized.
+
+>>> import pageindex, parser, config
+>>> c = config.parsingContext.copy()
+>>> c.pageIndex = pageindex.SetIndex([u"Main Page"])
+>>> html = parser.convertString("[[Main Page]] [[New Page]]", context=c)
+>>> for line in html.split("\\n")[3:]: print line.rstrip()
+<a href="/w/main_page.html">Main Page</a>
+<a class="missing" href="/w/new_page.html">New Page</a></p></div>
+"""
+
+import os, mmap, uuid, sqlite3, tempfile, threading
+
+# relative imports
+from namespaces import Local
+
+def fileStamp(path):
+    """
+    Modification time and size of file path, or None if it is missing.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+class PageIndex(object):
+    """
+    Abstract base class for page indexes.
+    """
+    def __init__(self):
+        if self.__class__ is PageIndex:
+            raise NotImplementedError
+        object.__init__(self)
+        self.token = uuid.uuid4().hex
+        self.changes = 0
+
+    def version(self):
+        """
+        Value that changes whenever the pages in the index may have,
+        so that renderings cached with an older version (see
+        config.ParsingContext.settingsKey()) are not reused.  Indexes
+        without this method are not cached at all.
+        """
+        return self.__class__.__name__, self.token, self.changes
+
+    def existing(self, names):
+        """
+        Set of those of names (normalized page names) that are pages.
+        """
+        raise NotImplementedError
+
+    def __contains__(self, name):
+        return name in self.existing([name])
+
+class SetIndex(PageIndex):
+    """
+    Index held in memory.
+
+    >>> import pageindex
+    >>> ix = pageindex.SetIndex([u"Main Page"])
+    >>> ix.add([u"Other page"])
+    >>> sorted(ix.existing([u"main_page", u"other_page", u"missing"]))
+    [u'main_page', u'other_page']
+    """
+    def __init__(self, titles=()):
+        PageIndex.__init__(self)
+        self.names = set()
+        self.add(titles)
+
+    def add(self, titles):
+        self.names.update(Local.normalize(t) for t in titles)
+        self.changes += 1
+
+    def remove(self, titles):
+        self.names.difference_update(Local.normalize(t) for t in titles)
+        self.changes += 1
+
+    def existing(self, names):
+        return self.names.intersection(names)
+
+class SortedFileIndex(PageIndex):
+    """
+    Index kept in a file of normalized names, one per line in UTF-8,
+    sorted, as written by write().  Lookups are binary searches of the
+    file mapped into memory, so it is never read whole.
+
+    >>> import pageindex, tempfile, os
+    >>> name = os.path.join(tempfile.mkdtemp(), "pages")
+    >>> pageindex.SortedFileIndex.write(name, [u"B", u"a", u"C c"])
+    >>> ix = pageindex.SortedFileIndex(name)
+    >>> sorted(ix.existing([u"a", u"c_c", u"b", u"d", u""]))
+    [u'a', u'b', u'c_c']
+    """
+    def __init__(self, path):
+        PageIndex.__init__(self)
+        self.path = path
+
+    @staticmethod
+    def write(path, titles):
+        """
+        Write an index of titles to path, replacing it at once.
+        """
+        names = sorted(set(Local.normalize(t).encode("utf-8")
+            for t in titles))
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        f = os.fdopen(fd, "wb")
+        try:
+            for n in names:
+                f.write(n + "\n")
+        finally:
+            f.close()
+        os.rename(temp, path)
+
+    def version(self):
+        return (self.__class__.__name__, os.path.abspath(self.path),
+            fileStamp(self.path))
+
+    def existing(self, names):
+        found = set()
+        f = open(self.path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return found
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for name in names:
+                    if self.search(m, size, name.encode("utf-8")):
+                        found.add(name)
+            finally:
+                m.close()
+        finally:
+            f.close()
+        return found
+
+    @staticmethod
+    def search(m, size, key):
+        """
+        True if key is a line of the sorted file mapped as m.
+        """
+        if not key or "\n" in key:
+            return False
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = m.rfind("\n", 0, mid) + 1
+            end = m.find("\n", start)
+            if -1 == end:
+                end = size
+            if m[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        end = m.find("\n", lo)
+        if -1 == end:
+            end = size
+        return lo < size and m[lo:end] == key
+
+class SQLiteIndex(PageIndex):
+    """
+    Index kept in a table of an SQLite database, which is created if
+    needed.  Each thread (and each process forked after connecting)
+    gets its own connection.  The names of a
+    document are looked up in one query (a few, for documents with
+    more than chunkSize distinct links).
+
+    >>> import pageindex
+    >>> ix = pageindex.SQLiteIndex(":memory:")
+    >>> ix.add([u"Main Page", u"Other"])
+    >>> sorted(ix.existing([u"main_page", u"missing", u"other"]))
+    [u'main_page', u'other']
+    """
+    chunkSize = 500
+
+    def __init__(self, path, table="pages"):
+        PageIndex.__init__(self)
+        self.path = path
+        self.table = table
+        self.local = threading.local()
+
+    def version(self):
+        if ":memory:" == self.path:
+            return PageIndex.version(self)
+        return (self.__class__.__name__, os.path.abspath(self.path),
+            self.table, fileStamp(self.path), self.changes)
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path)
+            db.execute("CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY)"
+                % self.table)
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def add(self, titles):
+        db = self.connection()
+        with db:
+            db.executemany("INSERT OR IGNORE INTO %s VALUES (?)" % self.table,
+                ((Local.normalize(t),) for t in titles))
+        self.changes += 1
+
+    def remove(self, titles):
+        db = self.connection()
+        with db:
+            db.executemany("DELETE FROM %s WHERE name = ?" % self.table,
+                ((Local.normalize(t),) for t in titles))
+        self.changes += 1
+
+    def existing(self, names):
+        db = self.connection()
+        names = list(names)
+        found = set()
+        for i in xrange(0, len(names), SQLiteIndex.chunkSize):
+            chunk = names[i:i+SQLiteIndex.chunkSize]
+            found.update(row[0] for row in db.execute(
+                "SELECT name FROM %s WHERE name IN (%s)" % (self.table,
+                ",".join("?" * len(chunk))), chunk))
+        return found
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -4,10 +4,10 @@ Handling EWC (Extended WikiCreole).
 See ewc.doc for a detailed explanation of the syntax of EWC itself.
 """
 
-import sys, re, StringIO, logging
+import sys, re, time, StringIO, logging
 
 # relative imports
-import config, utils, dom, namespaces, extensions
+import config, utils, dom, namespaces, extensions, arena
 
 def getClosedStyles(line):
     closed_style_pattern = re.compile(u"\\s*<<([#\\.][A-Za-z_][A-Za-z0-9_-]*)>>(.*)$")
@@ -43,7 +43,7 @@ def itemType(t):
     elif u":" == t: return dom.DictionaryDef
     else: return None
 
-def newLink(content):
+def newLink(content, pc=None):
     args = content.split(u"|", 1)
     link = args.pop(0)
 
@@ -51,7 +51,10 @@ def newLink(content):
         text = args.pop(0)
     else:
         ns, text = namespaces.getPrefix(link)
-    node = dom.Link(addr=namespaces.linkURL(link))
+    node = dom.Link(addr=namespaces.linkURL(link, pc))
+    page = namespaces.pageName(link, pc)
+    if page is not None:
+        node.attr["x-page"] = page
     node.addText(text)
     return node
 
@@ -61,7 +64,7 @@ def newSpan(name, content):
     s.addText(content)
     return s
 
-def newImage(content):
+def newImage(content, pc=None):
     args = content.split(u"|")
     src = args.pop(0)
 
@@ -70,7 +73,7 @@ def newImage(content):
     else:
         alt = src
 
-    node = dom.Image(addr=namespaces.imageURL(src))
+    node = dom.Image(addr=namespaces.imageURL(src, pc))
     node.attr["alt"] = alt
 
     if args:
@@ -83,55 +86,169 @@ def newImage(content):
 def newComment(content):
     return dom.Comment(val=content)
 
-def findSpanOrLink(node):
+def styleContent(content, tail):
     """
-    Find inline style spans and link markup.
-    Spans can be arbitrarily nested, and link text can contain spans,
-    but link text cannot contain nested links.
-    Yes, this is a lot hairier than a typical parser of such things,
-    mainly to maintain the "errorless syntax" restriction, so things
-    like missing or mismatched close tags are tolerated.
+    Style name and text of <<name content>> markup.  A closed style
+    like <<.name>> with no content borrows the next word of the tail.
     """
-    open_pattern = re.compile(                  # <<  [[
-        u"(.*?)(\\[\\[|<<)(.*)\\Z", re.DOTALL)
-    open_or_close_pattern1 = re.compile(        # <<  >>
-        u"(.*?)(<<|>>)(.*)\\Z", re.DOTALL)
-    open_or_close_pattern2 = re.compile(        # <<  ]]
-        u"(.*?)(<<|\\]\\])(.*)\\Z", re.DOTALL)
-    open_or_close_pattern3 = re.compile(        # <<  [[  >>
-        u"(.*?)(<<|\\[\\[|>>)(.*)\\Z", re.DOTALL)
     style_name_pattern = re.compile(
         u"([#\\.][A-Za-z_][A-Za-z0-9_-]*)\\s*(.*)\\Z")
 
-    m1 = open_pattern.match(node.value)
-    if not m1:
-        return None, None, None
-    pre, firsttag, tail = m1.groups()
+    m = style_name_pattern.match(content)
+    if not m:
+        name = None
+    else:
+        name, content = m.groups()
+    if not content:
+        c = []
+        i = 0
+        while i < len(tail)-1 and tail[i].isspace():
+            i += 1
+        while i < len(tail)-1 and not tail[i].isspace():
+            c.append(tail[i])
+            i += 1
+        content = u"".join(c)
+    return name, content
+
+def styleSpan(content, tail):
+    """
+    Build the span for <<name content>> markup.
+    """
+    return newSpan(*styleContent(content, tail))
 
-    depth = 1
-    stack = [firsttag]
-    inlink = (u"[[" == firsttag)
-    content = u""
+def insideLink(node):
+    """
+    True if text directly inside node is part of a link, which
+    suppresses the recognition of naked URLs.
+    """
+    while not isinstance(node, dom.Division):
+        if isinstance(node, dom.Link):
+            return True
+        node = node.parent
+    return False
 
-    while True:
-        if inlink:
-            if u"<<" == stack[-1]:
-                m2 = open_or_close_pattern1.match(tail)
+class InlineTokenizer(object):
+    """
+    Scan the value of a text node for inline markup, producing the
+    sequence of nodes (Text nodes and new inline elements) that
+    should replace it.
+
+    Markup is recognized in a fixed order of precedence: spans and
+    links, then images and comments, then span shortcuts, naked URLs,
+    and finally forced line breaks.  Text before a match is only
+    searched for markup of lower precedence, while text after it is
+    searched for everything again.  Rather than slicing and rescanning
+    the remaining text for each match, the tokenizer works on index
+    ranges of the original string and remembers where the next
+    trigger of each kind lies, so each text node is scanned once.
+
+    The tokens themselves are made by the link(), image(), comment(),
+    span(), style(), line_break() and plain() methods, which subclasses
+    can override to produce something other than dom nodes (see
+    scan.ScanTokenizer).
+
+    >>> import parser
+    >>> t = parser.InlineTokenizer(u"a **b** [[c]] {{d.png}}")
+    >>> [n.__class__.__name__ for n in t]
+    ['Text', 'Span', 'Text', 'Link', 'Text', 'Image']
+    >>> [n.value for n in t if isinstance(n, dom.Text)]
+    [u'a ', u' ', u' ']
+    """
+    SPAN, IMAGE, SHORTCUT, URL, BREAK, TEXT = range(6)
+
+    span_open_pattern = re.compile(u"\\[\\[|<<")        # <<  [[
+    span_close_pattern1 = re.compile(u"<<|>>")          # <<  >>
+    span_close_pattern2 = re.compile(u"<<|\\]\\]")      # <<  ]]
+    span_close_pattern3 = re.compile(u"<<|\\[\\[|>>")   # <<  [[  >>
+    shortcut_pattern = re.compile(u"##|//|,,|\\^\\^|__|\\*\\*")
+    scheme_pattern = re.compile(u"(?:http|https|ftp|mailto)\\:\\/\\/")
+    naked_url_pattern = re.compile(
+        u"(http|https|ftp|mailto)\\:\\/\\/([^\\s]*)")
+    image_pattern = re.compile(u"\\{\\{")
+    break_pattern = re.compile(u"\\\\\\\\")
+
+    span_types = {
+        u"#"    :    u".tt",    u"/"    :    u".i",
+        u","    :    u".sub",   u"^"    :    u".sup",
+        u"_"    :    u".u",     u"*"    :    u".b"
+    }
+
+    def __init__(self, text, inlink=False, pc=None):
+        object.__init__(self)
+        self.text = text
+        self.inlink = inlink
+        self.pc = pc or config.currentContext()
+        self.triggers = {}
+        self.closers = {}
+
+    def __iter__(self):
+        return self.main_generator()
+
+    def next_trigger(self, stage, pattern, pos):
+        """
+        Position of the first match of pattern at or after pos (or the
+        length of the text if there is none).  Ranges are visited left
+        to right, so the answer from the previous search for the same
+        stage stands until pos moves past it.
+        """
+        start, found = self.triggers.get(stage, (-1, -1))
+        if not (start <= pos <= found):
+            m = pattern.search(self.text, pos)
+            if m:
+                found = m.start()
             else:
-                m2 = open_or_close_pattern2.match(tail)
-        else:
-            m2 = open_or_close_pattern3.match(tail)
+                found = len(self.text)
+            self.triggers[stage] = (pos, found)
+        return found
 
-        if not m2:
-            content += tail
-            tail = u""
-            break
-        else:
-            c, tag, tail = m2.groups()
-            content += c
+    def next_closer(self, tag, pos):
+        """
+        Position of the first occurrence of tag at or after pos, or -1.
+        """
+        key = (tag, pos)
+        if key not in self.closers:
+            self.closers[key] = self.text.find(tag, pos)
+        return self.closers[key]
+
+    def find_span_or_link(self, lo, hi):
+        """
+        Find inline style spans and link markup.
+        Spans can be arbitrarily nested, and link text can contain spans,
+        but link text cannot contain nested links.
+        Yes, this is a lot hairier than a typical parser of such things,
+        mainly to maintain the "errorless syntax" restriction, so things
+        like missing or mismatched close tags are tolerated.
+        """
+        p = self.next_trigger(self.SPAN, self.span_open_pattern, lo)
+        if p + 2 > hi:
+            return None
+        text = self.text
+        firsttag = text[p:p+2]
+
+        stack = [firsttag]
+        inlink = (u"[[" == firsttag)
+        pos = p + 2
+
+        while True:
+            if inlink:
+                if u"<<" == stack[-1]:
+                    pattern = self.span_close_pattern1
+                else:
+                    pattern = self.span_close_pattern2
+            else:
+                pattern = self.span_close_pattern3
+
+            m = pattern.search(text, pos, hi)
+            if not m:
+                end, post = hi, hi
+                break
+
+            tag = m.group()
+            pos = m.end()
             if u">>" == tag or u"]]" == tag:
                 stack.pop()
                 if not stack:
+                    end, post = m.start(), pos
                     break
                 if u"]]" == tag:
                     inlink = False
@@ -139,118 +256,156 @@ def findSpanOrLink(node):
                 stack.append(tag)
                 if u"[[" == tag:
                     inlink = True
-            content += tag
 
-    if u"[[" == firsttag:
-        node = newLink(content)
-    else:
-        m = style_name_pattern.match(content)
-        if not m:
-            name = None
+        content = text[p+2:end]
+        if u"[[" == firsttag:
+            node = self.link(content)
         else:
-            name, content = m.groups()
-        if not content:
-            c = []
-            p = list(pre)
-            i = 0
-            while i < len(tail)-1 and tail[i].isspace():
-                p.append(tail[i])
-                i += 1
-            while i < len(tail)-1 and not tail[i].isspace():
-                c.append(tail[i])
-                i += 1
-            content = u"".join(c)
-        node = newSpan(name, content)
-    return node, pre, tail
-
-def findSpanShortcut(node):
-    span_types = {
-        u"#"    :    u".tt",    u"/"    :    u".i",
-        u","    :    u".sub",   u"^"    :    u".sup",
-        u"_"    :    u".u",     u"*"    :    u".b"
-    }
-    span_shortcut_pattern = re.compile(u"(.*?)(##|//|,,|\\^\\^|__|\\*\\*)(.*)\\Z", re.DOTALL)
+            node = self.style(content, text[post:hi])
+        return node, p, post
+
+    def find_image_or_comment(self, lo, hi):
+        p = self.next_trigger(self.IMAGE, self.image_pattern, lo)
+        if p + 2 > hi:
+            return None
+        end = self.next_closer(u"}}", p + 2)
+        if -1 == end or end + 2 > hi:
+            return None
+
+        content = self.text[p+2:end]
+        if content and u"!" == content[0]:
+            node = self.comment(content[1:])
+        else:
+            node = self.image(content)
+        return node, p, end + 2
+
+    def find_span_shortcut(self, lo, hi):
+        p = self.next_trigger(self.SHORTCUT, self.shortcut_pattern, lo)
+        if p + 2 > hi:
+            return None
+        tag = self.text[p:p+2]
+        type = InlineTokenizer.span_types[tag[0]]
+
+        if self.pc.emAndStrong:
+            if u"b" == type: type = u".strong"
+            elif u"i" == type: type = u".em"
+
+        end = self.next_closer(tag, p + 2)
+        if -1 == end or end + 2 > hi:
+            return None
+        node = self.span(type, self.text[p+2:end])
+        return node, p, end + 2
+
+    def find_naked_url(self, lo, hi):
+        if self.inlink or not self.pc.nakedURLs:
+            return None
+
+        p = self.next_trigger(self.URL, self.scheme_pattern, lo)
+        m = self.naked_url_pattern.match(self.text, p, hi)
+        if not m:
+            return None
 
-    m = span_shortcut_pattern.match(node.value)
-    if not m:
-        return None, None, None
+        scheme, name = m.groups()
+        node = self.link(u"".join([scheme, u"://", name, u"|", scheme, u"://", name]))
+        return node, p, m.end()
 
-    pre, tag, tail = m.groups()
-    type = span_types[tag[0]]
+    def find_break(self, lo, hi):
+        p = self.next_trigger(self.BREAK, self.break_pattern, lo)
+        if p + 2 > hi:
+            return None
+        return self.line_break(), p, p + 2
 
-    if config.parsingContext.emAndStrong:
-        if u"b" == type: type = u".strong"
-        elif u"i" == type: type = u".em"
+    def link(self, content):
+        return newLink(content, self.pc)
 
-    end = tail.find(tag)
-    if -1 == end:
-        return None, None, None
-    else:
-        content = tail[0:end]
-        post = tail[end+2:]
-    node = newSpan(type, content)
-    return node, pre, post
+    def image(self, content):
+        return newImage(content, self.pc)
 
-def findImageOrComment(node):
-    image_pattern = re.compile(u"(.*?)(\\{\\{)(.*?)(\\}\\})(.*)\\Z", re.DOTALL)
+    def comment(self, content):
+        return newComment(content)
 
-    m = image_pattern.match(node.value)
-    if not m:
-        return None, None, None
+    def span(self, name, content):
+        return newSpan(name, content)
 
-    pre, open, content, close, post = m.groups()
-    if content and u"!" == content[0]:
-        node = newComment(content[1:])
-    else:
-        node = newImage(content)
-    return node, pre, post
+    def style(self, content, tail):
+        return styleSpan(content, tail)
 
-def findNakedURL(node):
-    naked_url_pattern = re.compile(u"(.*?)(http|https|ftp|mailto)" \
-        "\\:\\/\\/([^\\s]*)(.*)\\Z", re.DOTALL)
+    def line_break(self):
+        return dom.Break()
 
-    if not config.parsingContext.nakedURLs:
-        return None, None, None
+    def plain(self, value):
+        if self.pc.quotesAndDashes:
+            value = utils.quotesAndDashes(value)
+        return dom.Text(val=value)
 
-    inlink = False
-    n = node.parent
-    while not isinstance(n, dom.Division):
-        if isinstance(n, dom.Link):
-            inlink = True
-            break
-        n = n.parent
-    if inlink:
-        return None, None, None
+    def main_generator(self):
+        finders = (self.find_span_or_link, self.find_image_or_comment,
+            self.find_span_shortcut, self.find_naked_url, self.find_break)
 
-    m = naked_url_pattern.match(node.value)
-    if not m:
-        return None, None, None
+        # Pending work in reverse document order: either a token ready
+        # to go out, or a (lo, hi, stage) range still to be searched.
+        pending = [(0, len(self.text), self.SPAN)]
+        self.triggers = {}
 
-    pre, scheme, name, post = m.groups()
-    node = newLink(u"".join([scheme, u"://", name, u"|", scheme, u"://", name]))
-    return node, pre, post
+        while pending:
+            item = pending.pop()
+            if not isinstance(item, tuple):
+                yield item
+                continue
+
+            lo, hi, stage = item
+            while stage < self.TEXT:
+                found = finders[stage](lo, hi)
+                if found:
+                    break
+                stage += 1
+
+            if stage == self.TEXT:
+                if lo < hi:
+                    yield self.plain(self.text[lo:hi])
+                continue
+
+            node, start, end = found
+            if end < hi:
+                pending.append((end, hi, self.SPAN))
+            pending.append(node)
+            pending.append((lo, start, stage + 1))
 
 class MarkupParser(object):
     """
     Parser object for WText. The main entry here is parse(), and the
     other methods here are just utilities for that.
+
+    Each parser has its own ParsingContext, a copy of the global
+    config.parsingContext unless one is given, so parsers in different
+    threads don't interfere.  The context is made current (see
+    config.currentContext()) while the parser is running.
     """
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, context=None):
         object.__init__(self)
         if logger:
             self.logger = logger
         else:
-            logging.getLogger("ewc")
+            self.logger = logging.getLogger("ewc")
+        if context:
+            self.context = context
+        else:
+            self.context = config.parsingContext.copy()
         self.clear_parser_state()
 
     def clear_parser_state(self):
         self.doc = dom.Document()
-        config.parsingContext.doc = self.doc
+        self.context.doc = self.doc
+        self.context.includes = []
         self.stack = [dom.Division(self.doc)]
         self.block_type = None
         self.styles = [[], []]
         self.prefix = u""
         self.compatible_table = False
+        self.span_table = None
+        self.span_row = None
+        self.column_owners = {}
+        self.row_owner = None
 
     def apply_styles(self, s, node):
         applyStyles(self.styles[s], node)
@@ -270,6 +425,8 @@ class MarkupParser(object):
 
     def open_div(self, name):
         self.close_to_div()
+        if len(self.stack) > self.context.nestingDepthLimit:
+            raise dom.NestingError("Exceeded nesting depth limit")
         d = dom.Division(self.stack[-1])
         self.stack.append(d)
         self.styles[0].append(name)
@@ -277,6 +434,8 @@ class MarkupParser(object):
         self.apply_styles(1, d)
 
     def new_block(self, bt):
+        if len(self.stack) > self.context.nestingDepthLimit:
+            raise dom.NestingError("Exceeded nesting depth limit")
         if not bt:
             bt = dom.Paragraph
         self.block_type = bt
@@ -325,11 +484,22 @@ class MarkupParser(object):
             else:
                 self.new_block(dom.TableData)
 
+            cell = self.stack[-1]
             tb = self.stack[-3]
             tr = self.stack[-2]
             row = len(tb) - 1
             col = len(tr) - 1
 
+            # A merged cell extends the nearest unmerged cell above or to
+            # its left.  Those are kept track of here: per column for the
+            # current table, and for the current row.
+            if tb is not self.span_table:
+                self.span_table = tb
+                self.column_owners = {}
+            if tr is not self.span_row:
+                self.span_row = tr
+                self.row_owner = None
+
             rowspan, colspan = False, False
             if c and u"^" == c[0]:
                 rowspan = True
@@ -339,22 +509,18 @@ class MarkupParser(object):
                 c = c[1:].lstrip()
 
             styles, text = getClosedStyles(c)
-            applyStyles(styles, self.stack[-1])
-
-            if colspan:
-                c = col
-                if 0 != c:
-                    self.stack[-1].colspan = -1
-                    while -1 == tr[c].colspan:
-                        c -= 1
-                    tr[c].colspan += 1
-            if rowspan:
-                r = row
-                if 0 != r:
-                    self.stack[-1].rowspan = -1
-                    while -1 == tb[r][col].rowspan:
-                        r -= 1
-                    tb[r][col].rowspan += 1
+            applyStyles(styles, cell)
+
+            if colspan and 0 != col:
+                cell.colspan = -1
+                self.row_owner.colspan += 1
+            else:
+                self.row_owner = cell
+            if rowspan and 0 != row and col in self.column_owners:
+                cell.rowspan = -1
+                self.column_owners[col].rowspan += 1
+            else:
+                self.column_owners[col] = cell
 
             self.stack[-1].addText(text)
 
@@ -465,112 +631,210 @@ class MarkupParser(object):
     open_div_pattern = re.compile(u"\\s*<<([#\\.][A-Za-z_][A-Za-z0-9_-]*)$")
     close_div_pattern = re.compile(u"\\s*>>(.*)$")
 
+    def do_block_line(self, line):
+        while True:
+            m = MarkupParser.close_div_pattern.match(line)
+            if m:
+                self.close_div()
+                line = m.group(1)
+            else:
+                break
+
+        self.styles[0], line = getClosedStyles(line)
+
+        m = MarkupParser.open_div_pattern.match(line)
+        if m:
+            name = m.group(1)
+            self.open_div(name)
+            line = u""
+
+        if not line:
+            self.close_to_div()
+            self.styles[1] = self.styles[0]
+            self.styles[0] = []
+            return
+        elif line.startswith(u"=="):
+            self.new_heading(line)
+            return
+        elif line.startswith(u"----"):
+            self.new_rule()
+            return
+
+        self.add_line(line) # tables and lists and such done here
+
+        self.styles[1] = self.styles[0]
+        self.styles[0] = []
+
     def doBlockMarkup(self, source):
+        for block in self.iterBlocks(source):
+            pass
+
+    def bound(self, generator):
+        """
+        Step through generator with this parser's context current,
+        restoring whatever was current in between steps.
+        """
+        while True:
+            previous = config.activate(self.context)
+            try:
+                try:
+                    item = generator.next()
+                except StopIteration:
+                    return
+            finally:
+                config.activate(previous)
+            yield item
+
+    def iterBlocks(self, source, keep=True):
+        """
+        Do block markup, yielding each top-level block (a child of the
+        outermost Division) as soon as it is complete, that is, once the
+        parser has closed it and moved on.  Unless keep is true, each
+        block is removed from the document when the caller resumes.
+        """
+        return self.bound(self.block_generator(source, keep))
+
+    def finished(self):
+        """
+        Number of top-level blocks that are complete: all of them,
+        unless the parser is still adding to the last.
+        """
+        if len(self.stack) > 1:
+            return len(self.stack[0]) - 1
+        return len(self.stack[0])
+
+    def block_generator(self, source, keep):
+        root = self.stack[0]
+        done = 0
         lines = 0
+
         for line in source:
             lines += 1
             if ((lines % 1000) == 0):
                 self.logger.info("%d lines." % lines)
 
+            self.do_block_line(line)
+
             while True:
-                m = MarkupParser.close_div_pattern.match(line)
-                if m:
-                    self.close_div()
-                    line = m.group(1)
-                else:
+                if done >= self.finished():
                     break
-
-            self.styles[0], line = getClosedStyles(line)
-
-            m = MarkupParser.open_div_pattern.match(line)
-            if m:
-                name = m.group(1)
-                self.open_div(name)
-                line = u""
-
-            if not line:
-                self.close_to_div()
-                self.styles[1] = self.styles[0]
-                self.styles[0] = []
-                continue
-            elif line.startswith(u"=="):
-                self.new_heading(line)
-                continue
-            elif line.startswith(u"----"):
-                self.new_rule()
-                continue
-
-            self.add_line(line) # tables and lists and such done here
-
-            self.styles[1] = self.styles[0]
-            self.styles[0] = []
+                block = root[done]
+                yield block
+                if keep:
+                    done += 1
+                else:
+                    root.remove(block)
 
         self.logger.info("%d lines." % lines)
 
+        while done < len(root):
+            block = root[done]
+            yield block
+            if keep:
+                done += 1
+            else:
+                root.remove(block)
+
     def doInlineMarkup(self, node):
         """
         Walk the tree doing inline markup inside all the Text nodes.
-        We traverse in an odd way to accommodate the fact that inline
-        markup may split text nodes into spans while the traversal is
-        going on.
+        Each Text node is replaced by the nodes its InlineTokenizer
+        produces; new elements are then walked in turn, since spans
+        and links can contain further markup.  The new list of
+        children is built up separately and swapped in at the end.
         """
-        for i, n in enumerate(node):
-            if not isinstance(n, dom.Text):
-                self.doInlineMarkup(n)
-            else:
-                for func in (findSpanOrLink, findImageOrComment, findSpanShortcut, findNakedURL):
-                    while True:
-                        new_node, pre, post = func(n)
-                        if None is new_node:
-                            break
-                        else:
-                            n.value = pre
-                            if post:
-                                node.insert(i+1, dom.Text(val=post))
-                            node.insert(i+1, new_node)
-                    if not n.value:
-                        continue
-
-                while True:
-                    b = n.value.find(u"\\\\")
-                    if -1 == b:
-                        break
-                    post = n.value[b+2:]
-                    n.value = n.value[:b]
-                    if post:
-                        node.insert(i+1, dom.Text(val=post))
-                    node.insert(i+1, dom.Break())
+        previous = config.activate(self.context)
+        try:
+            self.inline_markup(node)
+        finally:
+            config.activate(previous)
+
+    def inline_markup(self, node):
+        limit = self.context.nestingDepthLimit
+        pending = [(node, 0)]
+        while pending:
+            node, depth = pending.pop()
+            if depth > limit:
+                raise dom.NestingError("Exceeded nesting depth limit")
+
+            inlink = None
+            children = []
+            for n in node:
+                children.append(n)
+                if not isinstance(n, dom.Text):
+                    pending.append((n, depth + 1))
+                    continue
+
+                if inlink is None:
+                    inlink = self.context.nakedURLs and insideLink(node)
+                tokens = list(InlineTokenizer(n.value, inlink, self.context))
+                if tokens and isinstance(tokens[0], dom.Text):
+                    n.value = tokens.pop(0).value
+                else:
+                    n.value = u""
 
-                if config.parsingContext.quotesAndDashes:
-                    n.value = utils.quotesAndDashes(n.value)
+                for t in tokens:
+                    children.append(node._ok_to_add(t))
+                    if not isinstance(t, dom.Text):
+                        pending.append((t, depth + 1))
+            node.children = children
 
     def removeEscapes(self, node):
-        if not isinstance(node, dom.Text):
-            for n in node:
-                self.removeEscapes(n)
-        else:
-            node.value = utils.removeEscapes(node.value)
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            if not isinstance(node, dom.Text):
+                pending.extend(node.children)
+            else:
+                node.value = utils.removeEscapes(node.value)
 
     def doMagicComments(self, node):
         """
         Traverse the dom tree interpreting "magical" comment nodes.
         Happens after all markup processing.
         """
-        if not isinstance(node, dom.Comment):
-            for n in node:
-                self.doMagicComments(n)
-        else:
-            pass
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            if not isinstance(node, dom.Comment):
+                pending.extend(node.children)
+            else:
+                pass
 
-    def parse(self, source):
+    def parse(self, source, flat=False):
         """
-        Create document from input source.
+        Create document from input source.  If flat is true, the
+        document is built in an arena.NodeStore instead of as a tree
+        of dom objects; each top-level block is copied into the store
+        as soon as it is finished, so only one block at a time exists
+        as objects.
         """
         self.clear_parser_state()
-
+        if flat:
+            return self.parse_flat(source)
+        previous = config.activate(self.context)
+        try:
+            sink = self.context.sink
+            if sink is not None:
+                return self.parse_instrumented(source, sink)
+            return self.parse_document(source)
+        finally:
+            config.activate(previous)
+
+    def parse_flat(self, source):
+        store = arena.NodeStore()
+        doc = store.create(dom.Document)
+        root = store.create(dom.Division, doc)
+        for block in self.parseBlocks(source, keep=False):
+            root.append(block)
+        self.doc = doc
+        self.context.doc = doc
+        return doc
+
+    def parse_document(self, source):
         pass1 = utils.UnicodeTransform(source)
         pass2 = utils.EscapeTransform(iter(pass1))
-        pass3 = extensions.ExtensionTransform(iter(pass2))
+        pass3 = extensions.ExtensionTransform(iter(pass2), self.context)
 
         self.doBlockMarkup(pass3)
 
@@ -580,18 +844,125 @@ class MarkupParser(object):
         self.doc.normalize()
         return self.doc
 
-def convertString(ins, hd=0):
+    def parse_instrumented(self, source, sink):
+        """
+        Same as parse(), but run each pass to completion before the
+        next so that each can be timed, and report to sink.
+        """
+        start = [time.time()]
+        def lap(name):
+            now = time.time()
+            sink.phase(name, now - start[0])
+            start[0] = now
+
+        pass1 = utils.UnicodeTransform(source)
+        lines = list(pass1)
+        lap("unicode")
+        lines = list(utils.EscapeTransform(iter(lines)))
+        lap("escape")
+        pass3 = extensions.ExtensionTransform(iter(lines), self.context)
+        lines = list(pass3)
+        lap("extension")
+
+        self.doBlockMarkup(iter(lines))
+        lap("block")
+        self.doInlineMarkup(self.doc)
+        lap("inline")
+        self.doMagicComments(self.doc)
+        lap("magic")
+        self.removeEscapes(self.doc)
+        lap("unescape")
+        self.doc.normalize()
+        lap("normalize")
+
+        sink.count("documents")
+        sink.count("lines", pass1.lines)
+        sink.count("blocks", len(self.stack[0]))
+        nodes = {}
+        pending = [self.doc]
+        while pending:
+            node = pending.pop()
+            name = node.__class__.__name__
+            nodes[name] = nodes.get(name, 0) + 1
+            pending.extend(node.children)
+        for name, n in nodes.iteritems():
+            sink.count("nodes", n, name)
+        for name, n in pass3.invocations.iteritems():
+            sink.count("extensions", n, name)
+        sink.maximum("includeDepth", pass3.depth)
+        return self.doc
+
+    def parseBlocks(self, source, keep=True):
+        """
+        Parse input source incrementally.  Returns an iterator over the
+        top-level blocks of the document, each one fully processed as
+        soon as it is complete, so output can be written long before
+        the end of the input is read.  See iterBlocks() for keep.
+        """
+        self.clear_parser_state()
+
+        pass1 = utils.UnicodeTransform(source)
+        pass2 = utils.EscapeTransform(iter(pass1))
+        pass3 = extensions.ExtensionTransform(iter(pass2), self.context)
+
+        blocks = self.block_generator(pass3, keep)
+        return self.bound(self.finish_blocks(blocks))
+
+    def finish_blocks(self, blocks):
+        for block in blocks:
+            self.doInlineMarkup(block)
+            self.doMagicComments(block)
+            self.removeEscapes(block)
+            block.normalize()
+            yield block
+
+def convertString(ins, hd=0, context=None):
     """
+    Convert a source string to HTML.  Settings come from context if
+    given, or else from a copy of the global config.parsingContext.
+
     >>> import config, utils, dom, namespaces, extensions, parser
     >>> source = open("tests/parser.in").read()
     >>> html = parser.convertString(source)
     >>> res = open("tests/parser.out").read()
     >>> res == html
     True
+    >>> c = config.parsingContext.copy()
+    >>> c.localLinkPattern = "/wiki/%s"
+    >>> parser.convertString("[[Page]]", context=c)
+    u'\\n<div>\\n<p>\\n<a href="/wiki/page">Page</a></p></div>'
+    >>> parser.convertString("[[Page]]")
+    u'\\n<div>\\n<p>\\n<a href="/w/page.html">Page</a></p></div>'
     """
     source = StringIO.StringIO(ins)
-    doc = MarkupParser().parse(source)
-    return u"".join(doc.visit(dom.HTMLDomVisitor(hd)))
+    p = MarkupParser(context=context)
+    doc = p.parse(source)
+    writer = dom.HTMLWriter(hd, context=p.context)
+    sink = p.context.sink
+    if sink is None:
+        return writer.render(doc).decode(writer.encoding)
+
+    start = time.time()
+    html = writer.render(doc)
+    sink.phase("render", time.time() - start)
+    sink.count("bytes", len(html))
+    return html.decode(writer.encoding)
+
+def convertStream(inf, outf, hd=0, context=None):
+    """
+    Like convertString(), but reads lines from inf and writes HTML to
+    outf block by block, without holding the whole document in memory.
+
+    >>> import parser, StringIO
+    >>> source = ["== Title ==", "", "Some **bold** text.", "* one", "* two"]
+    >>> out = StringIO.StringIO()
+    >>> parser.convertStream(iter(source), out)
+    >>> out.getvalue() == parser.convertString("\\n".join(source))
+    True
+    """
+    p = MarkupParser(context=context)
+    blocks = p.parseBlocks(inf, keep=False)
+    dom.HTMLWriter(hd, context=p.context).write(p.doc, outf, blocks)
 
 #
 # End of code.
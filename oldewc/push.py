@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+push.py: A module from EWC (http://piclab.com/ewc/).
+
+Parsing input that arrives a piece at a time, such as from a socket
+or an upload, without waiting for all of it.  Pieces can be cut
+anywhere, even in the middle of a line or of a multi-byte character.
+Each is decoded and split into lines, and whole lines are passed
+through the usual escape, extension and block stages as they come,
+so top-level blocks (or their HTML) are produced as soon as the input
+that finishes them has been fed.
+
+>>> import push, parser
+>>> source = "== Title ==\\n\\nSome **bold** text \\\\\\ncontinued.\\n* one\\n"
+>>> p = push.PushParser(html=True)
+>>> [p.feed(source[i:i+5]) for i in xrange(0, 25, 5)]
+[[], [], ['\\n<div>', '\\n<h1>Title</h1>'], [], []]
+>>> html = "".join(p.feed(source[25:]) + p.close())
+>>> "\\n<div>\\n<h1>Title</h1>" + html == parser.convertString(source)
+True
+"""
+
+import codecs, collections
+
+# relative imports
+import config, utils, dom, extensions, parser
+
+class Pause(unicode):
+    """
+    Marker passed up through the line transforms in place of a line
+    when all the input fed so far has been read.
+    """
+    __slots__ = ()
+
+PAUSE = Pause()
+
+class BlockPending(Exception):
+    """
+    Raised to the extension transform, in place of PAUSE, when an
+    extension is reading its block and all the input fed so far has
+    been read.
+    """
+
+class PushParser(object):
+    """
+    Parser fed with feed() and close() rather than given a source.
+
+    Lines go through utils.EscapeTransform.push() one by one, so line
+    continuations can be split between pieces.  The transformed lines
+    are then held back while they are inside an extension block, until
+    the line that ends it (see extensions.blockEnd()), since the block
+    is read all at once; the others are passed on to an ordinary
+    ExtensionTransform, which is given PAUSE instead of a line whenever
+    it has caught up with the input.  (So an extension whose block()
+    reads past its end pattern won't work here.)  Finished blocks are
+    done as by MarkupParser.parseBlocks().
+
+    A block can also be opened by the expansion of an extension, such
+    as an included file ending in an unclosed <<!, which can't be told
+    from the source line.  The lines coming out of an expansion are
+    kept back until the transform is done with it, and if an extension
+    reads its block past the input fed so far (BlockPending), those
+    lines are dropped, the lines read since are put back, and all
+    input is held until close(), when it is transformed again from
+    there.
+
+    Both feed() and close() return a list of what the input given has
+    finished: if html is true, encoded HTML to be written out in turn
+    (and blocks are dropped from the document once written);
+    otherwise the top-level blocks of the document, self.doc.  Input
+    given as str is decoded with encoding, or with the context's
+    inputEncoding.
+
+    >>> import push
+    >>> p = push.PushParser(encoding="utf-8")
+    >>> text = u"A\\u00e9 [[Page]] <<raw\\n//x//\\n>>\\n\\nB\\n".encode("utf-8")
+    >>> [len(p.feed(c)) for c in text[:3], text[3:20], text[20:]]
+    [0, 0, 1]
+    >>> blocks = p.close()
+    >>> [b.__class__.__name__ for b in p.doc[0]]
+    ['Paragraph', 'Paragraph']
+    >>> p.doc[0][0][0].value
+    u'A\\xe9 '
+    """
+    def __init__(self, hd=0, context=None, html=False, encoding=None):
+        object.__init__(self)
+        self.parser = parser.MarkupParser(context=context)
+        self.context = self.parser.context
+        self.html = html
+        self.writer = dom.HTMLWriter(hd, context=self.context)
+        self.decoder = codecs.getincrementaldecoder(
+            encoding or self.context.inputEncoding)("ignore")
+        self.partial = []
+        self.escapes = utils.EscapeTransform(None)
+        self.held = []
+        self.end_pattern = None
+        self.ready = collections.deque()
+        self.closed = False
+        self.opened = False
+        self.done = 0
+        self.holding = False
+        self.pending = []
+        self.consumed = []
+        self.invoked = {}
+        self.included = 0
+        self.start_transform()
+
+    def _getdoc(self):
+        return self.parser.doc
+    doc = property(_getdoc)
+
+    def start_transform(self):
+        self.transform = extensions.ExtensionTransform(self.released(),
+            self.context)
+        self.transform.invocations = dict(self.invoked)
+        self.lines = iter(self.transform)
+
+    def released(self):
+        while True:
+            if self.ready:
+                line = self.ready.popleft()
+                self.consumed.append(line)
+                yield line
+            elif self.closed:
+                return
+            elif self.transform.in_block:
+                raise BlockPending()
+            else:
+                yield PAUSE
+
+    def feed(self, data):
+        """
+        Take the next piece of input.
+        """
+        if self.closed:
+            raise ValueError("feed() after close()")
+        if not isinstance(data, unicode):
+            data = self.decoder.decode(data)
+        self.partial.append(data)
+        if not u"\n" in data:
+            return []
+
+        lines = u"".join(self.partial).split(u"\n")
+        self.partial = [lines.pop()]
+        for line in lines:
+            self.push_line(line)
+        return self.advance()
+
+    def close(self):
+        """
+        Finish the input, returning the rest of the output.
+        """
+        if self.closed:
+            return []
+        self.partial.append(self.decoder.decode("", True))
+        rest = u"".join(self.partial)
+        self.partial = []
+        if rest:
+            self.push_line(rest)
+        if self.escapes.previous is not None:
+            self.held.append(self.escapes.previous)
+            self.escapes.previous = None
+        self.ready.extend(self.held)
+        self.held = []
+        self.closed = True
+
+        out = self.advance()
+        if self.html:
+            if self.opened:
+                out.append(self.writer.render_end(self.doc))
+            else:
+                out.append(self.writer.render(self.doc))
+        return out
+
+    def push_line(self, line):
+        line = self.escapes.push(line)
+        if line is None:
+            return
+        self.held.append(line)
+        if self.holding:
+            return
+        if self.end_pattern is None:
+            self.end_pattern = extensions.blockEnd(line)
+        elif line.startswith(self.end_pattern):
+            self.end_pattern = extensions.blockEnd(
+                line[len(self.end_pattern):])
+
+        if self.end_pattern is None:
+            self.ready.extend(self.held)
+            self.held = []
+
+    def advance(self):
+        """
+        Run the released lines through the extension and block stages,
+        returning the output for the blocks they finish.
+        """
+        p = self.parser
+        out = []
+        previous = config.activate(self.context)
+        try:
+            try:
+                for line in self.lines:
+                    if len(self.transform.stack) > 1:
+                        self.pending.append(line)
+                        continue
+                    self.commit(out)
+                    if line is PAUSE:
+                        break
+                    p.do_block_line(line)
+                    self.take(p.finished(), out)
+            except BlockPending:
+                self.roll_back()
+            if self.closed:
+                self.commit(out)
+                self.take(len(p.stack[0]), out)
+        finally:
+            config.activate(previous)
+        return out
+
+    def commit(self, out):
+        """
+        Parse the lines kept back from expansions, now that the
+        transform is done with them.
+        """
+        p = self.parser
+        if self.pending:
+            for line in self.pending:
+                p.do_block_line(line)
+                self.take(p.finished(), out)
+            self.pending = []
+            self.invoked = dict(self.transform.invocations)
+        self.consumed = []
+        if self.context.includes is not None:
+            self.included = len(self.context.includes)
+
+    def roll_back(self):
+        """
+        Undo the transform back to the last commit(), and hold all the
+        input from there until close().
+        """
+        self.held[:0] = self.consumed + list(self.ready)
+        self.ready.clear()
+        self.consumed = []
+        self.pending = []
+        if self.context.includes is not None:
+            del self.context.includes[self.included:]
+        self.end_pattern = None
+        self.holding = True
+        self.start_transform()
+
+    def take(self, complete, out):
+        root = self.parser.stack[0]
+        if self.done >= complete:
+            return
+        blocks = root.children[self.done:complete]
+        for b in self.parser.finish_blocks(blocks):
+            if not self.html:
+                out.append(b)
+                continue
+            if not self.opened:
+                out.append(self.writer.render_start(self.doc))
+                self.opened = True
+            out.append(self.writer.render(b))
+            root.remove(b)
+
+        if not self.html:
+            self.done = complete
+
+def convertChunks(chunks, hd=0, context=None):
+    """
+    Like parser.convertStream(), but for input in pieces of any size,
+    yielding the HTML of each block as soon as it is finished.
+
+    >>> import push, parser, bench
+    >>> source = "\\n".join(bench.manualCorpus(1).split("\\n")[:90])
+    >>> html = "".join(push.convertChunks(source[i:i+7]
+    ...     for i in xrange(0, len(source), 7)))
+    >>> html == parser.convertString(source).encode("ascii")
+    True
+
+    Blocks opened by an expansion rather than by the source are read
+    once the input is complete:
+
+    >>> import config, extensions, tempfile, os
+    >>> d = tempfile.mkdtemp()
+    >>> open(os.path.join(d, "x.inc"), "w").write("Top.\\n<<!\\n")
+    >>> c = config.parsingContext.copy()
+    >>> c.includePath = d
+    >>> c.addExtension(u"include", extensions.IncludeFile())
+    >>> for source in ["<<m<<x>>\\n", "A\\n\\n<<include x.inc>>\\nB\\n>>C\\n",
+    ...     "A\\n\\n<<include x.inc>>\\nB\\n"]:
+    ...     html = "".join(push.convertChunks(source, context=c))
+    ...     print html == parser.convertString(source, context=c.copy())
+    True
+    True
+    True
+    """
+    p = PushParser(hd, context, True)
+    for chunk in chunks:
+        for html in p.feed(chunk):
+            yield html
+    for html in p.close():
+        yield html
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
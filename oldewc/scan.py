@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+scan.py: A module from EWC (http://piclab.com/ewc/).
+
+Scanning documents for what they contain without converting them:
+outgoing links and images, headings, the extensions and included
+files used, and a count of words.  A scan reads the same block and
+inline markup as the parser (the same source passes run first, and
+inline markup is found by a subclass of parser.InlineTokenizer), but
+no dom nodes are built and nothing is rendered, so it is several
+times quicker than a full conversion.  Useful for link tables,
+search indexes and the like.
+
+>>> import scan
+>>> s = scan.scanString(u"== Intro ==\\n"
+...     u"See [[Main Page|here]], [[wp:Python]] and {{logo.png|Logo}}.\\n"
+...     u"* An **item** on [[http://example.com/|a site]]\\n")
+>>> s.links
+[(u'', u'main_page'), (u'wp', u'Python'), (u'http', u'http://example.com/')]
+>>> s.images
+[(u'', u'logo.png')]
+>>> s.headings
+[(1, u'Intro')]
+>>> s.words
+10
+"""
+
+import re, StringIO
+
+# relative imports
+import config, utils, namespaces, extensions, parser
+
+# Words: runs of letters and digits, with apostrophes inside them
+word_pattern = re.compile(u"[^\\W_]+(?:['\u2019][^\\W_]+)*", re.UNICODE)
+
+def target(name, pc, page=True):
+    """
+    Namespace and target of the link (or image, if page is false)
+    markup name, with the target normalized as far as it can be
+    without making a URL: local pages by namespaces.pageName(), URLs
+    with standard schemes kept whole.
+    """
+    name = utils.removeEscapes(name).lstrip().rstrip()
+    if not name or u"/" == name[0] or u"#" == name[0]:
+        return u"", name
+
+    ns, tail = namespaces.getPrefix(name)
+    if ns in config.standardURISchemes:
+        return ns, name
+    if page:
+        p = namespaces.pageName(name, pc)
+        if p is not None:
+            return ns, p
+    return ns, tail.lstrip().rstrip()
+
+class Token(object):
+    """
+    What a ScanTokenizer produces in place of an inline element: its
+    kind (one of the InlineTokenizer stages), and for links and spans
+    the text inside, which is scanned in turn.
+    """
+    __slots__ = ("kind", "inner")
+
+    def __init__(self, kind, inner=None):
+        self.kind = kind
+        self.inner = inner
+
+class ScanTokenizer(parser.InlineTokenizer):
+    """
+    Inline tokenizer that reports links and images to a Summary, and
+    yields plain text as strings and everything else as Tokens.
+
+    Unless text is wanted exactly as it would be rendered, span
+    shortcuts and forced line breaks are left in the plain text: they
+    contain nothing to collect, and their markup (which is made of
+    characters that aren't parts of words) separates words as well as
+    the spans would.  Shortcuts still have to be found when naked URLs
+    are on, since they end URLs.
+
+    >>> import scan
+    >>> s = scan.Summary()
+    >>> t = scan.ScanTokenizer(u"a **b** [[c|d]] {{e.png}}", summary=s)
+    >>> [x if isinstance(x, unicode) else x.inner for x in t]
+    [u'a **b** ', u'd', u' ', None]
+    >>> t = scan.ScanTokenizer(u"a **b**", summary=s, exact=True)
+    >>> [x if isinstance(x, unicode) else x.inner for x in t]
+    [u'a ', u'b']
+    >>> s.links, s.images
+    ([(u'', u'c')], [(u'', u'e.png')])
+    """
+    def __init__(self, text, inlink=False, pc=None, summary=None,
+        exact=False):
+        parser.InlineTokenizer.__init__(self, text, inlink, pc)
+        self.summary = summary
+        self.exact = exact
+
+    def find_span_shortcut(self, lo, hi):
+        if not (self.exact or self.pc.nakedURLs):
+            return None
+        return parser.InlineTokenizer.find_span_shortcut(self, lo, hi)
+
+    def find_break(self, lo, hi):
+        if not self.exact:
+            return None
+        return parser.InlineTokenizer.find_break(self, lo, hi)
+
+    def link(self, content):
+        args = content.split(u"|", 1)
+        self.summary.links.append(target(args[0], self.pc))
+        if 2 == len(args):
+            text = args[1]
+        else:
+            ns, text = namespaces.getPrefix(args[0])
+        return Token(self.SPAN, text)
+
+    def image(self, content):
+        self.summary.images.append(target(content.split(u"|", 1)[0],
+            self.pc, False))
+        return Token(self.IMAGE)
+
+    def comment(self, content):
+        return Token(self.IMAGE)
+
+    def span(self, name, content):
+        return Token(self.SHORTCUT, content)
+
+    def style(self, content, tail):
+        return Token(self.SHORTCUT, parser.styleContent(content, tail)[1])
+
+    def line_break(self):
+        return Token(self.BREAK)
+
+    def plain(self, value):
+        return value
+
+class Summary(object):
+    """
+    Results of a scan.  links and images are lists of (namespace,
+    target) in document order, headings a list of (level, text),
+    extensions a dictionary of the number of uses of each extension,
+    includes the paths of the files included, and words the number
+    of words of text.
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.links = []
+        self.images = []
+        self.headings = []
+        self.extensions = {}
+        self.includes = []
+        self.words = 0
+
+class Scanner(object):
+    """
+    Scanner with the same block structure as parser.MarkupParser,
+    reduced to what decides which lines of text belong together:
+    paragraphs, list items and table cells are gathered up as the
+    parser would gather their text, and each is scanned for inline
+    markup once it is complete.
+
+    >>> import scan
+    >>> s = scan.Scanner().scan([u"|= Name |= Link", u"| raw | {{{[[x]]}}}"])
+    >>> s.links, s.extensions, s.words
+    ([], {u'raw': 1}, 4)
+    """
+    def __init__(self, context=None):
+        object.__init__(self)
+        if context:
+            self.context = context
+        else:
+            self.context = config.parsingContext.copy()
+        self.clear_scanner_state()
+
+    def clear_scanner_state(self):
+        self.summary = Summary()
+        self.context.doc = None
+        self.context.includes = []
+        self.lines = []
+        self.block = None
+        self.compatible_table = False
+        self.in_cell = False
+
+    # Openings of all the inline markup a ScanTokenizer looks for
+    # (naked URLs aside), so that text without any can be skipped
+    trigger_pattern = re.compile(u"\\[\\[|<<|\\{\\{")
+
+    def inline(self, text, inlink=False, out=None):
+        """
+        Scan text for inline markup, counting its words, and appending
+        its pieces of plain text to out if given (in which case they
+        are exactly those that would be rendered).
+        """
+        summary = self.summary
+        exact = out is not None
+        if not (exact or self.context.nakedURLs or
+            Scanner.trigger_pattern.search(text)):
+            summary.words += len(word_pattern.findall(
+                utils.removeEscapes(text)))
+            return
+
+        limit = self.context.nestingDepthLimit
+        stack = [(iter(ScanTokenizer(text, inlink, self.context, summary,
+            exact)), inlink)]
+        while stack:
+            tokens, inlink = stack[-1]
+            for t in tokens:
+                if isinstance(t, unicode):
+                    t = utils.removeEscapes(t)
+                    summary.words += len(word_pattern.findall(t))
+                    if out is not None:
+                        out.append(t)
+                elif t.inner:
+                    if len(stack) > limit:
+                        raise parser.dom.NestingError(
+                            "Exceeded nesting depth limit")
+                    inner = inlink or t.kind == ScanTokenizer.SPAN
+                    stack.append((iter(ScanTokenizer(t.inner, inner,
+                        self.context, summary, exact)), inner))
+                    break
+            else:
+                stack.pop()
+
+    def flush(self):
+        if self.lines:
+            self.inline(u"\n".join(self.lines))
+            self.lines = []
+        self.in_cell = False
+
+    def close_block(self):
+        self.flush()
+        self.block = None
+        self.compatible_table = False
+
+    def heading(self, line):
+        self.close_block()
+        i = 2
+        while not ((i > 7) or (i >= len(line)) or (u"=" != line[i])):
+            i += 1
+        out = []
+        self.inline(line[i:].lstrip().rstrip(u"=").rstrip(), False, out)
+        self.summary.headings.append((max(1, min(6, i - 1)), u"".join(out)))
+
+    def cells(self, cells):
+        if self.in_cell:
+            first = cells.pop(0).lstrip().rstrip()
+            if first:
+                self.lines.append(first)
+        for c in cells:
+            self.flush()
+            c = c.lstrip().rstrip()
+            if c and u"=" == c[0]:
+                c = c[1:].lstrip()
+            if c and c[0] in u"^<":
+                c = c[1:].lstrip()
+            styles, text = parser.getClosedStyles(c)
+            self.lines.append(text)
+            self.in_cell = True
+
+    def table_line(self, line):
+        if u"table" != self.block:
+            self.block = u"table"
+            self.compatible_table = not line.startswith(u"||")
+
+        if self.compatible_table:
+            self.flush()
+            self.cells(line[1:].split(u"|"))
+            return
+        if line.startswith(u"||"):
+            self.flush()
+            line = line[2:]
+        self.cells(line.split(u"|"))
+
+    def plain_line(self, line):
+        if self.compatible_table:
+            self.close_block()
+        if not self.block:
+            self.block = u"p"
+        elif u"table" == self.block:
+            self.table_line(line)
+            return
+        self.lines.append(line)
+
+    def line(self, line):
+        t = line[0]
+        if t in u"*#:;":
+            i = 0
+            while i < len(line) and line[i] in u"*#:;":
+                i += 1
+            rest = line[i:]
+            if rest and not rest[0].isspace():
+                self.plain_line(line)
+                return
+            if self.block and u"item" != self.block:
+                self.close_block()
+            self.flush()
+            self.block = u"item"
+            styles, rest = parser.getClosedStyles(rest.lstrip())
+            self.lines.append(rest)
+        elif u"|" == t:
+            if self.block and u"table" != self.block:
+                self.close_block()
+            self.table_line(line)
+        else:
+            self.plain_line(line)
+
+    def block_line(self, line):
+        # Most lines have no divisions or styles to look for
+        while u">>" in line:
+            m = parser.MarkupParser.close_div_pattern.match(line)
+            if not m:
+                break
+            self.close_block()
+            line = m.group(1)
+
+        if u"<<" in line:
+            styles, line = parser.getClosedStyles(line)
+            if parser.MarkupParser.open_div_pattern.match(line):
+                line = u""
+
+        if not line:
+            self.close_block()
+        elif line.startswith(u"=="):
+            self.heading(line)
+        elif line.startswith(u"----"):
+            self.close_block()
+        else:
+            self.line(line)
+
+    def scan(self, source):
+        """
+        Scan the lines of source, returning a Summary.
+        """
+        self.clear_scanner_state()
+        previous = config.activate(self.context)
+        try:
+            pass1 = utils.UnicodeTransform(source)
+            pass2 = utils.EscapeTransform(iter(pass1))
+            pass3 = extensions.ExtensionTransform(iter(pass2), self.context)
+            for line in pass3:
+                self.block_line(line)
+            self.close_block()
+        finally:
+            config.activate(previous)
+
+        self.summary.extensions = dict(pass3.invocations)
+        self.summary.includes = list(self.context.includes)
+        return self.summary
+
+def scanString(ins, context=None):
+    """
+    Scan a source string.  Settings come from context if given, or
+    else from a copy of the global config.parsingContext.
+    """
+    return Scanner(context).scan(StringIO.StringIO(ins))
+
+# End of code
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
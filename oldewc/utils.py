@@ -6,6 +6,7 @@ General utilities for EWC that are used by the parser and may be
 handy for things like user-written extensions.
 """
 
+import re
 import sys
 
 def makeUnicode(ins):
@@ -60,31 +61,37 @@ class UnicodeTransform(object):
                 sys.stdout.flush()
             yield line.decode(self.encoding, "ignore")
 
+# Character-level rules.  Each of the passes below is one scan of a
+# compiled pattern, with a table or a small function for the
+# replacement of each match, and returns text with no matches as is.
+
+tilde_pattern = re.compile(u"~(-*)(.?)", re.DOTALL)
+
+def _tilde(m):
+    # "~-" escapes the dash and leaves the tilde to escape what follows
+    c = m.group(2)
+    if c:
+        c = unichr(0xEF00 + ord(c))
+    else:
+        c = u"\u00A0"
+    return u"\uEF2D" * len(m.group(1)) + c
+
 def tildeEscapes(ins):
     """
     Implement tilde escapes by shifting the escaped characters by 0xEF00,
     moving them into the Unicode private use area.
     They'll be shifted back after all further processing.
+
+    >>> import utils
+    >>> utils.tildeEscapes(u"a~*b~~c~")
+    u'a\\uef2ab\\uef7ec\\xa0'
+    >>> utils.tildeEscapes(u"~--x")
+    u'\\uef2d\\uef2d\\uef78'
     """
     assert isinstance(ins, unicode)
-    v = list(ins)
-
-    i = 0
-    while True:
-        if i == len(v) - 1:
-            if u"~" == v[i]:
-                v[i] = u"\u00A0"
-                break
-        if i > len(v) - 1:
-            break
-        if u"~" == v[i]:
-            v[i] = unichr(0xEF00 + ord(v[i+1]))
-            if u"-" == v[i+1]:
-                v[i+1] = u"~"
-            else:
-                del v[i+1]
-        i += 1
-    return u"".join(v)
+    if not u"~" in ins:
+        return ins
+    return tilde_pattern.sub(_tilde, ins)
 
 class EscapeTransform(object):
     """
@@ -102,6 +109,7 @@ class EscapeTransform(object):
         object.__init__(self)
         self.source = source
         self.encoding = None
+        self.previous = None
         try:
             self.encoding = self.source.encoding
         except AttributeError:
@@ -113,28 +121,51 @@ class EscapeTransform(object):
         return self.main_generator()
 
     def main_generator(self):
-        previous = None
+        self.previous = None
         for line in self.source:
-            line = tildeEscapes(line.rstrip())
-
-            if previous is not None:
-                line = previous + line
-                previous = None
-
-            n = -1
-            try:
-                while u"\\" == line[n]:
-                    n -= 1
-            except IndexError:
-                pass
-
-            if not (n & 1):
-                previous = line[:-1]
-            else:
+            line = self.push(line)
+            if line is not None:
                 yield line
 
-        if previous is not None:
-            yield previous
+        if self.previous is not None:
+            yield self.previous
+
+    def push(self, line):
+        """
+        Take one source line, returning the escaped line it completes,
+        or None if it is continued on the next (in which case what it
+        has so far is kept in self.previous).
+
+        >>> import utils
+        >>> e = utils.EscapeTransform(None)
+        >>> e.push(u"a \\\\"), e.push(u"b~\\\\"), e.push(u"c")
+        (None, u'a b\\uef5c', u'c')
+        """
+        line = tildeEscapes(line.rstrip())
+
+        if self.previous is not None:
+            line = self.previous + line
+            self.previous = None
+
+        n = -1
+        try:
+            while u"\\" == line[n]:
+                n -= 1
+        except IndexError:
+            pass
+
+        if not (n & 1):
+            self.previous = line[:-1]
+            return None
+        return line
+
+# Escaped characters shifted back, and control codes (other than tab
+# and newline) removed, including escaped ones
+unescapes = dict((unichr(0xEF00 + c), unichr(c)) for c in range(0x100))
+for _c in range(0x00,0x09) + range(0x0B,0x20) + range(0x7F,0xA0):
+    unescapes[unichr(_c)] = u""
+    unescapes[unichr(0xEF00 + _c)] = u""
+unescape_pattern = re.compile(u"[\x00-\x08\x0B-\x1F\x7F-\x9F\uEF00-\uEFFF]")
 
 def removeEscapes(ins):
     """
@@ -144,14 +175,15 @@ def removeEscapes(ins):
     >>> utils.removeEscapes(u"A\uEF42C\u0008D\u0081E\uEF46G")
     u'ABCDEFG'
     """
-    removables = map(unichr, (range(0x00,0x09) + range(0x0B,0x20) + range(0x7F,0xA0)))
-
     assert isinstance(ins, unicode)
-    v = list(ins)
-    for i in xrange(len(v)):
-        if 0xEF00 <= ord(v[i]) <= 0xEFFF:
-            v[i] = unichr(ord(v[i]) - 0xEF00)
-    return u"".join([c for c in v if not c in removables])
+    if not unescape_pattern.search(ins):
+        return ins
+    return unescape_pattern.sub(lambda m: unescapes[m.group()], ins)
+
+quote_pattern = re.compile(u"-+|[\"']")
+can_precede = frozenset(u" \t\n\u00A0(\u201C\u2018\u2014")
+can_follow = frozenset(u" \t\n\u00A0):;'\",.?!\u201D\u2019\u2014")
+quote_marks = { u"\"": (u"\u201C", u"\u201D"), u"'": (u"\u2018", u"\u2019") }
 
 def quotesAndDashes(ins):
     """
@@ -165,47 +197,60 @@ def quotesAndDashes(ins):
     >>> utils.quotesAndDashes(u"You're apostropes aren't quotes.")
     u"You're apostropes aren't quotes."
     """
-    can_precede = list(u" \t\n\u00A0(\u201C\u2018\u2014")
-    can_follow = list(u" \t\n\u00A0):;'\",.?!\u201D\u2019\u2014")
-
     assert isinstance(ins, unicode)
     if not ins:
         return ins
 
-    v = list(ins)
-    v.insert(0, u" ")
-    v.append(u" ")
-
+    # Only the quotes and runs of dashes change; everything between
+    # them is copied.  pre is the character before each match as it
+    # will be written, which may itself have been converted.
+    out = []
+    pos = 0
+    pre = u" "
     converted_endash = False
-    for i in xrange(1, len(v)-1):
-        pre = v[i-1]
-        if u"-" == v[i]:
-            if u"\uEF2D" == pre:
-                v[i] = u"\uEF2D"
-            elif u"-" == pre:
-                v[i-1] = u"\u0000"
-                v[i] = u"\u2013" # En dash
-                converted_endash = True
-            elif u"\u2013" == pre:
-                if converted_endash:
-                    v[i-1] = u"\u0000"
-                    v[i] = u"\u2014" # Em dash
+    for m in quote_pattern.finditer(ins):
+        start = m.start()
+        if start > pos:
+            out.append(ins[pos:start])
+            pre = ins[start-1]
+        pos = m.end()
+        c = m.group()
+
+        if u"-" == c[0]:
+            run = []
+            for i in xrange(len(c)):
+                if u"\uEF2D" == pre:
+                    pre = u"\uEF2D"
+                elif u"-" == pre:
+                    run[-1] = u""
+                    pre = u"\u2013" # En dash
+                    converted_endash = True
+                elif u"\u2013" == pre and converted_endash:
+                    if run:
+                        run[-1] = u""
+                    else:
+                        out[-1] = out[-1][:-1]
+                    pre = u"\u2014" # Em dash
                     converted_endash = False
+                else:
+                    pre = u"-"
+                run.append(pre)
+            out.append(u"".join(run))
             continue
 
-        post = v[i+1]
-        if u"\"" == v[i]:
-            if pre in can_precede and not post.isspace():
-                v[i] = u"\u201C" # Left double quote
-            elif post in can_follow and not pre.isspace():
-                v[i] = u"\u201D" # Right double quote
-        elif u"'" == v[i]:
-            if pre in can_precede and not post.isspace():
-                v[i] = u"\u2018" # Left single quote
-            elif post in can_follow and not pre.isspace():
-                v[i] = u"\u2019" # Right single quote
-
-    return u"".join([c for c in v[1:-1] if not u"\u0000" == c])
+        post = ins[pos:pos+1] or u" "
+        if pre in can_precede and not post.isspace():
+            c = quote_marks[c][0]
+        elif post in can_follow and not pre.isspace():
+            c = quote_marks[c][1]
+        out.append(c)
+        pre = c
+
+    out.append(ins[pos:])
+    out = u"".join(out)
+    if u"\u0000" in out:
+        out = out.replace(u"\u0000", u"")
+    return out
 
 # End of code
 